@@ -2,17 +2,131 @@
 import os
 import json
 import urllib.parse
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, jsonify, request, send_file
 from flask_cors import CORS
 import mimetypes
 import subprocess
 import datetime
+import threading
+import time
+import atexit
+import contextlib
+import hashlib
+import bisect
+import array
+import math
+import sys
+import uuid
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+try:
+    import numpy as np
+except ImportError:  # 沒有 numpy 時退回固定時間點縮圖
+    np = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 沒有 Pillow 時停用縮圖拼貼，前端改逐張載入
+    Image = None
 
 app = Flask(__name__)
 CORS(app)
 
 DATA_FILE = 'data.json'
 LAST_PATH_FILE = 'last_path.json'
+PLAYBACK_EVENTS_FILE = 'playback_events.jsonl'
+PLAYBACK_STATS_FILE = 'playback_stats.json'
+TRANSCODE_STATE_FILE = 'transcode_state.json'
+
+# 播放事件批次寫入設定
+PLAYBACK_FLUSH_INTERVAL = 10          # 秒，緩衝區最長停留時間
+PLAYBACK_FLUSH_SIZE = 200             # 緩衝事件數達到此值立即寫入
+PLAYBACK_COMPACT_BYTES = 1024 * 1024  # 事件日誌超過此大小時壓縮成快照
+PLAYBACK_MAX_WATCHED = 600            # 單次心跳最多計入的觀看秒數
+PLAYBACK_SORT_KEYS = ('play_count', 'watch_time', 'last_played')
+
+# 記憶體目錄（catalog）設定
+CATALOG_FIELDS = ('filename', 'tag', 'path', 'description', 'duration', 'thumbnail', 'size', 'add_time')
+CATALOG_SORT_KEYS = ('filename', 'size', 'duration', 'add_time')
+CATALOG_PATH_LIST_FIELDS = ('multi_thumbnails', 'subtitles')  # 內含 path 的清單欄位
+ADD_TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+SIZE_UNITS = {'Bytes': 0, 'KB': 1, 'MB': 2, 'GB': 3, 'TB': 4, 'PB': 5}
+
+# 影片處理排程設定：每個儲存裝置各自限制並行數，CPU 則全域共用
+MEDIA_DEVICE_CONCURRENCY = 2
+MEDIA_CPU_CONCURRENCY = os.cpu_count() or 4
+
+# 媒體快取（關鍵影格索引等）依 (路徑, 大小, 修改時間) 建立鍵值
+CACHE_DIR = 'cache'
+KEYFRAME_CACHE_DIR = os.path.join(CACHE_DIR, 'keyframes')
+KEYFRAME_MEMORY_ENTRIES = 256   # 記憶體中保留的索引數量
+KEYFRAME_SNAP_TOLERANCE = 2.0   # 與關鍵影格相差在此秒數內時直接對齊
+
+# 內嵌字幕與音軌：探測結果與擷取出的 WebVTT 都依 (路徑, 大小, 修改時間) 快取
+PROBE_CACHE_DIR = os.path.join(CACHE_DIR, 'probe')
+SUBTITLE_CACHE_DIR = os.path.join(CACHE_DIR, 'subtitles')
+TEXT_SUBTITLE_CODECS = ('subrip', 'srt', 'ass', 'ssa', 'webvtt', 'mov_text', 'text')
+EMBEDDED_LANGUAGE_CODES = {
+    'chi': '中文', 'zho': '中文', 'eng': '英文', 'jpn': '日文', 'kor': '韓文',
+    'fre': '法文', 'fra': '法文', 'ger': '德文', 'deu': '德文', 'spa': '西班牙文'
+}
+
+# 智慧縮圖選擇：以低解析度灰階串流為候選畫面評分
+SMART_THUMB_WIDTH = 160
+SMART_THUMB_HEIGHT = 90
+SMART_THUMB_MAX_FRAMES = 600   # 整部影片最多取樣的畫面數
+SMART_THUMB_CHUNK = 64         # 每次從管線讀入並向量化計算的畫面數
+
+# 縮圖延遲生成：第一次被請求時才產生，失敗後以指數退避延後重試
+THUMBNAIL_WORKERS = MEDIA_CPU_CONCURRENCY
+THUMBNAIL_RETRY_BASE = 60           # 秒
+THUMBNAIL_RETRY_MAX = 24 * 60 * 60  # 秒
+DEFAULT_THUMBNAIL = 'static/thumbnails/default.png'
+
+# 縮圖拼貼（sprite）：一次回傳一整頁列表縮圖
+TILE_CACHE_DIR = os.path.join(CACHE_DIR, 'tiles')
+SPRITE_CACHE_DIR = os.path.join(CACHE_DIR, 'sprites')
+SPRITE_MAX_TILES = 200
+SPRITE_MAX_COLUMNS = 10
+SPRITE_CACHE_MAX_FILES = 200
+TILE_CACHE_MAX_FILES = 5000
+SPRITE_JPEG_QUALITY = 80
+
+# 影片庫健康檢查：每個磁碟區只探測一次，離線磁碟區上的影片保留並標記為 offline
+VOLUME_PROBE_TIMEOUT = 3        # 秒，探測單一磁碟區是否可用的上限
+HEALTH_STAT_WORKERS = 16        # 平行 stat 的執行緒數
+HEALTH_STAT_TIMEOUT = 30        # 秒，整批 stat 的上限
+HEALTH_CACHE_SECONDS = 30       # /api/health/library 結果的快取時間
+MOUNT_PARENTS = ('/mnt', '/media', '/run/media', '/Volumes')
+
+# 批次轉檔：CPU 編碼預設、每個工作使用的執行緒數與預估記憶體
+TRANSCODE_PRESETS = {
+    'h264': ['-c:v', 'libx264', '-preset', 'medium', '-crf', '23',
+             '-c:a', 'aac', '-b:a', '128k'],
+    'hevc': ['-c:v', 'libx265', '-preset', 'medium', '-crf', '26', '-tag:v', 'hvc1',
+             '-c:a', 'aac', '-b:a', '128k']
+}
+TRANSCODE_THREADS_PER_JOB = 4
+TRANSCODE_DEVICE_CONCURRENCY = 1          # 每個儲存裝置同時轉檔數，與互動用的處理名額分開
+TRANSCODE_MEMORY_PER_JOB = 1024 ** 3      # 位元組
+TRANSCODE_DURATION_TOLERANCE = 1.0        # 秒，輸出與來源時長可容許的差距
+
+# 滑鼠移入預覽片段：從時間軸上取數段 1 秒片段串成靜音小檔
+PREVIEW_CACHE_DIR = os.path.join(CACHE_DIR, 'previews')
+PREVIEW_SEGMENTS = 6
+PREVIEW_SEGMENT_SECONDS = 1
+PREVIEW_WIDTH = 320
+PREVIEW_FPS = 15
+PREVIEW_CACHE_MAX_BYTES = 512 * 1024 * 1024
+PREVIEW_PRUNE_GRACE = 60        # 秒，最近使用過的片段可能仍在傳送中，清理時跳過
+PREVIEW_FORMATS = {
+    'mp4': ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '32', '-pix_fmt', 'yuv420p',
+            '-movflags', '+faststart', '-f', 'mp4'],
+    'webm': ['-c:v', 'libvpx-vp9', '-b:v', '300k', '-deadline', 'realtime', '-cpu-used', '8',
+             '-f', 'webm']
+}
 
 # 全局變量用於追蹤縮圖生成進度
 thumbnail_progress = {}
@@ -20,6 +134,29 @@ thumbnail_progress = {}
 # 全局變量用於追蹤正在生成縮圖的影片，防止重複生成
 generating_videos = set()
 
+# data.json 的所有讀改寫都需持有此鎖；寫入以原子替換，不持鎖的讀取也不會讀到半個檔案
+data_file_lock = threading.RLock()
+
+def load_videos():
+    with open(DATA_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_videos(videos):
+    """以原子替換方式寫入 data.json（需持有 data_file_lock）"""
+    tmp_path = DATA_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(videos, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, DATA_FILE)
+
+def update_video_entry(video_path, **fields):
+    """重新讀取 data.json 並更新指定影片的欄位，避免覆蓋期間其他請求的修改"""
+    with data_file_lock:
+        videos = load_videos()
+        for video in videos:
+            if video['path'] == video_path:
+                video.update(fields)
+        save_videos(videos)
+
 def allowed_file(filename):
     return filename.lower().endswith(('.mp4', '.mkv', '.avi', '.mov'))
 
@@ -109,45 +246,541 @@ def validate_subtitle_content(subtitle_path):
     except Exception:
         return False
 
-def get_video_duration(path):
+# ===== 影片處理排程 =====
+# 同一顆硬碟同時跑太多 ffmpeg 會造成磁頭來回尋軌，因此每個儲存裝置
+# 各有自己的並行上限，再共用一個 CPU 上限；批次工作依裝置輪流派送。
+
+media_cpu_slots = threading.BoundedSemaphore(MEDIA_CPU_CONCURRENCY)
+media_device_slots = {}
+media_device_lock = threading.Lock()
+
+def get_storage_device(path):
+    """取得檔案所在的儲存裝置識別（st_dev，無法 stat 時退回磁碟機或掛載點）"""
     try:
-        result = subprocess.run(
+        return os.stat(path).st_dev
+    except OSError:
+        drive, rest = os.path.splitdrive(os.path.abspath(path))
+        if drive:
+            return drive.upper()
+        # 非 Windows 路徑：往上找到掛載點
+        mount = os.path.dirname(os.path.abspath(path))
+        while not os.path.ismount(mount):
+            parent = os.path.dirname(mount)
+            if parent == mount:
+                break
+            mount = parent
+        return mount
+
+def get_device_slot(device):
+    with media_device_lock:
+        if device not in media_device_slots:
+            media_device_slots[device] = threading.BoundedSemaphore(MEDIA_DEVICE_CONCURRENCY)
+        return media_device_slots[device]
+
+@contextlib.contextmanager
+def media_slot(path):
+    """佔用影片所在裝置與 CPU 的處理名額（先裝置後 CPU，避免死結）"""
+    device_slot = get_device_slot(get_storage_device(path))
+    with device_slot:
+        with media_cpu_slots:
+            yield
+
+def run_media_command(path, command, **kwargs):
+    """在排程名額內執行 ffmpeg/ffprobe 指令"""
+    with media_slot(path):
+        return subprocess.run(command, **kwargs)
+
+def run_media_jobs(paths, func):
+    """依儲存裝置分組並輪流派送 func(path)，回傳 {path: 結果}
+
+    以輪轉游標派送：每個空出的名額交給上一次派送裝置的下一個裝置，
+    讓所有硬碟輪流取得名額，單一裝置也不會超過 MEDIA_DEVICE_CONCURRENCY 個並行工作。
+    """
+    queues = {}
+    order = deque()
+    for path in paths:
+        device = get_storage_device(path)
+        if device not in queues:
+            queues[device] = deque()
+            order.append(device)
+        queues[device].append(path)
+
+    results = {}
+    active = defaultdict(int)
+    running = {}
+
+    def next_device():
+        # 從游標位置找下一個還有名額的裝置，找到後游標移到它的下一個
+        for _ in range(len(order)):
+            device = order[0]
+            order.rotate(-1)
+            if active[device] < MEDIA_DEVICE_CONCURRENCY:
+                return device
+        return None
+
+    with ThreadPoolExecutor(max_workers=MEDIA_CPU_CONCURRENCY) as pool:
+        while order or running:
+            while len(running) < MEDIA_CPU_CONCURRENCY:
+                device = next_device()
+                if device is None:
+                    break
+                path = queues[device].popleft()
+                if not queues[device]:
+                    del queues[device]
+                    order.remove(device)
+                active[device] += 1
+                running[pool.submit(func, path)] = (device, path)
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                device, path = running.pop(future)
+                active[device] -= 1
+                try:
+                    results[path] = future.result()
+                except Exception as e:
+                    print(f"處理影片失敗 {path}: {e}")
+                    results[path] = None
+    return results
+
+def get_duration_seconds(path):
+    """獲取影片總秒數，失敗時回傳 0"""
+    try:
+        result = run_media_command(
+            path,
             ['ffprobe', '-v', 'error', '-show_entries',
              'format=duration', '-of',
              'default=noprint_wrappers=1:nokey=1', path],
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT
         )
-        duration = float(result.stdout)
+        return float(result.stdout)
+    except (ValueError, OSError):
+        return 0
+
+def get_video_duration(path):
+    try:
+        duration = get_duration_seconds(path)
+        if duration <= 0:
+            return "未知"
         mins = int(duration // 60)
         secs = int(duration % 60)
         return f"{mins}:{secs:02d}"
     except:
         return "未知"
 
-def generate_thumbnail(video_path):
+# ===== 關鍵影格索引 =====
+# 每部影片只用 ffprobe 讀一次封包旗標，將關鍵影格的時間點（float64）與
+# 檔案位移（uint64）存成緊湊的二進位檔，之後的縮圖與預覽都直接跳到關鍵影格。
+
+keyframe_indexes = OrderedDict()   # 快取鍵 -> 索引；無法擷取的影片記為 None
+keyframe_lock = threading.Lock()
+keyframe_extract_locks = {}
+
+def get_media_cache_key(path):
+    """以 (路徑, 大小, 修改時間) 產生快取鍵，檔案變動時自動失效"""
+    stat = os.stat(path)
+    raw = f"{path}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def extract_keyframe_index(video_path):
+    """以 ffprobe 封包旗標擷取關鍵影格，回傳 (時間點陣列, 位移陣列)"""
+    result = run_media_command(
+        video_path,
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+         '-show_entries', 'packet=pts_time,pos,flags',
+         '-of', 'csv=p=0', video_path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+    times = array.array('d')
+    offsets = array.array('Q')
+    if result.returncode != 0:
+        return times, offsets  # 無法解析的檔案視為沒有關鍵影格
+    for line in result.stdout.decode(errors='ignore').splitlines():
+        parts = line.split(',')
+        if len(parts) < 3 or 'K' not in parts[2]:
+            continue
+        try:
+            times.append(float(parts[0]))
+            offsets.append(int(parts[1]) if parts[1].isdigit() else 0)
+        except ValueError:
+            continue
+    # 封包依解碼順序輸出，排序後才能二分搜尋
+    order = sorted(range(len(times)), key=times.__getitem__)
+    return array.array('d', (times[i] for i in order)), array.array('Q', (offsets[i] for i in order))
+
+def load_keyframe_file(index_path):
+    with open(index_path, 'rb') as f:
+        count = array.array('Q')
+        count.fromfile(f, 1)
+        times = array.array('d')
+        times.fromfile(f, count[0])
+        offsets = array.array('Q')
+        offsets.fromfile(f, count[0])
+    return times, offsets
+
+def save_keyframe_file(index_path, times, offsets):
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        array.array('Q', [len(times)]).tofile(f)
+        times.tofile(f)
+        offsets.tofile(f)
+    os.replace(tmp_path, index_path)
+
+def remember_keyframe_index(key, index):
+    with keyframe_lock:
+        keyframe_indexes[key] = index
+        keyframe_indexes.move_to_end(key)
+        while len(keyframe_indexes) > KEYFRAME_MEMORY_ENTRIES:
+            keyframe_indexes.popitem(last=False)
+
+def get_keyframe_index(video_path):
+    """獲取影片的關鍵影格索引（記憶體 → 磁碟快取 → ffprobe），失敗時回傳 None
+
+    擷取失敗（純音訊、損壞或無法讀取的檔案）也以相同快取鍵記錄，
+    檔案未變動前不再重新掃描；同一影片的並行請求只執行一次 ffprobe。
+    """
+    try:
+        key = get_media_cache_key(video_path)
+    except OSError:
+        return None
+
+    with keyframe_lock:
+        if key in keyframe_indexes:
+            keyframe_indexes.move_to_end(key)
+            return keyframe_indexes[key]
+        lock = keyframe_extract_locks.setdefault(key, threading.Lock())
+
+    with lock:
+        with keyframe_lock:
+            if key in keyframe_indexes:
+                return keyframe_indexes[key]
+
+        index_path = os.path.join(KEYFRAME_CACHE_DIR, key + '.idx')
+        failed_path = os.path.join(KEYFRAME_CACHE_DIR, key + '.failed')
+        index = None
+        if not os.path.exists(failed_path):
+            try:
+                index = load_keyframe_file(index_path)
+            except (OSError, EOFError):
+                try:
+                    index = extract_keyframe_index(video_path)
+                except OSError as e:
+                    # 無法啟動 ffprobe 可能是暫時性問題，只記在記憶體
+                    print(f"擷取關鍵影格失敗 {video_path}: {e}")
+                else:
+                    if index[0]:
+                        save_keyframe_file(index_path, *index)
+                    else:
+                        index = None
+                        os.makedirs(KEYFRAME_CACHE_DIR, exist_ok=True)
+                        open(failed_path, 'w').close()
+        remember_keyframe_index(key, index)
+
+    with keyframe_lock:
+        keyframe_extract_locks.pop(key, None)
+    return index
+
+def find_nearest_keyframe(video_path, timestamp):
+    """回傳最接近 timestamp 的關鍵影格資訊，沒有索引時回傳 None"""
+    index = get_keyframe_index(video_path)
+    if index is None:
+        return None
+    times, offsets = index
+    pos = bisect.bisect_right(times, timestamp)
+    previous = max(pos - 1, 0)
+    following = min(pos, len(times) - 1)
+    nearest = previous if abs(times[previous] - timestamp) <= abs(times[following] - timestamp) else following
+    return {
+        'timestamp': times[nearest],
+        'offset': offsets[nearest],
+        'previous': times[previous],
+        'next': times[following]
+    }
+
+def get_seek_args(video_path, timestamp, snap=False):
+    """產生放在 -i 之前的 seek 參數，回傳 (參數, 實際時間點)
+
+    時間點靠近關鍵影格（或 snap=True）時直接對齊該關鍵影格並關閉精確 seek，
+    ffmpeg 只需解碼一個畫面；否則從前一個關鍵影格開始解碼到指定時間。
+    """
+    keyframe = find_nearest_keyframe(video_path, timestamp)
+    if keyframe and (snap or abs(keyframe['timestamp'] - timestamp) <= KEYFRAME_SNAP_TOLERANCE):
+        return ['-ss', f"{keyframe['timestamp']:.3f}", '-noaccurate_seek'], keyframe['timestamp']
+    return ['-ss', f'{timestamp:.3f}'], timestamp
+
+# ===== 內嵌字幕與音軌 =====
+# 探測每部影片的內嵌字幕與音軌；文字字幕在第一次被請求時以單一 ffmpeg
+# 同時擷取所有軌道為 WebVTT，之後直接由快取提供。
+
+embedded_subtitle_sources = {}   # 快取中的 .vtt 路徑 -> 影片路徑
+subtitle_extract_locks = {}
+subtitle_extract_lock = threading.Lock()
+
+def probe_media_streams(video_path):
+    """列出影片內嵌的字幕與音軌，結果依檔案狀態快取於 cache/probe"""
+    key = get_media_cache_key(video_path)
+    probe_path = os.path.join(PROBE_CACHE_DIR, key + '.json')
+    if os.path.exists(probe_path):
+        with open(probe_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    result = run_media_command(
+        video_path,
+        ['ffprobe', '-v', 'error',
+         '-show_entries', 'stream=index,codec_type,codec_name,channels:stream_tags=language,title',
+         '-of', 'json', video_path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+    streams = json.loads(result.stdout or b'{}').get('streams', [])
+
+    tracks = {'audio': [], 'subtitles': []}
+    for stream in streams:
+        tags = stream.get('tags', {})
+        track = {
+            'stream_index': stream.get('index'),
+            'codec': stream.get('codec_name', ''),
+            'language_code': tags.get('language', ''),
+            'title': tags.get('title', '')
+        }
+        if stream.get('codec_type') == 'audio':
+            track['channels'] = stream.get('channels', 0)
+            tracks['audio'].append(track)
+        elif stream.get('codec_type') == 'subtitle':
+            track['text'] = track['codec'] in TEXT_SUBTITLE_CODECS
+            tracks['subtitles'].append(track)
+
+    os.makedirs(PROBE_CACHE_DIR, exist_ok=True)
+    # 寫入暫存檔再替換，並行讀取時不會讀到寫到一半的 JSON
+    tmp_path = f"{probe_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(tracks, f, ensure_ascii=False)
+    os.replace(tmp_path, probe_path)
+    return tracks
+
+def get_embedded_subtitle_path(video_path, stream_index):
+    return os.path.join(SUBTITLE_CACHE_DIR, f"{get_media_cache_key(video_path)}_{stream_index}.vtt")
+
+def run_subtitle_extraction(video_path, outputs):
+    """以單一 ffmpeg 擷取 [(串流索引, 目標路徑)]，回傳擷取失敗的項目"""
+    command = ['ffmpeg', '-v', 'error', '-y', '-i', video_path]
+    for stream_index, target in outputs:
+        command += ['-map', f'0:{stream_index}', '-c:s', 'webvtt', '-f', 'webvtt', target + '.tmp']
+    result = run_media_command(video_path, command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    failed = []
+    for output in outputs:
+        target = output[1]
+        if result.returncode == 0 and os.path.exists(target + '.tmp'):
+            os.replace(target + '.tmp', target)
+        else:
+            if os.path.exists(target + '.tmp'):
+                os.remove(target + '.tmp')
+            failed.append(output)
+    return failed
+
+def extract_embedded_subtitles(video_path):
+    """以單一 ffmpeg 將所有尚未快取的文字字幕軌擷取為 WebVTT
+
+    擷取失敗的軌道以同一快取鍵留下 .failed 標記，檔案未變動前不再重試。
+    """
+    with subtitle_extract_lock:
+        lock = subtitle_extract_locks.setdefault(video_path, threading.Lock())
+    try:
+        # 同一部影片的並行請求等待同一次擷取
+        with lock:
+            outputs = []
+            for track in probe_media_streams(video_path)['subtitles']:
+                target = get_embedded_subtitle_path(video_path, track['stream_index'])
+                if track['text'] and not os.path.exists(target) and not os.path.exists(target + '.failed'):
+                    outputs.append((track['stream_index'], target))
+            if not outputs:
+                return
+
+            os.makedirs(SUBTITLE_CACHE_DIR, exist_ok=True)
+            failed = run_subtitle_extraction(video_path, outputs)
+            if failed and len(outputs) > 1:
+                # 一條軌道損壞會讓整次擷取失敗，逐條重試找出真正失敗的軌道
+                failed = [output for output in failed if run_subtitle_extraction(video_path, [output])]
+            for _, target in failed:
+                open(target + '.failed', 'w').close()
+    finally:
+        with subtitle_extract_lock:
+            subtitle_extract_locks.pop(video_path, None)
+
+def find_embedded_subtitles(video_path):
+    """將內嵌文字字幕整理成與 find_subtitle_files 相同的格式"""
+    try:
+        tracks = probe_media_streams(video_path)
+    except (OSError, ValueError) as e:
+        print(f"探測內嵌字幕失敗 {video_path}: {e}")
+        return []
+
+    subtitles = []
+    for track in tracks['subtitles']:
+        if not track['text']:
+            continue  # 圖形字幕（PGS、VobSub）無法轉成 WebVTT
+        cache_path = get_embedded_subtitle_path(video_path, track['stream_index'])
+        embedded_subtitle_sources[cache_path] = video_path
+        language = (EMBEDDED_LANGUAGE_CODES.get(track['language_code'].lower()) or
+                    detect_subtitle_language(track['title'] or track['language_code']))
+        label = track['title'] or track['language_code'] or '字幕'
+        subtitles.append({
+            'path': cache_path,
+            'filename': f"{label} (內嵌 #{track['stream_index']})",
+            'language': language,
+            'format': 'VTT',
+            'size': get_readable_size(os.path.getsize(cache_path)) if os.path.exists(cache_path) else '未擷取',
+            'embedded': True,
+            'stream_index': track['stream_index']
+        })
+    return subtitles
+
+# ===== 智慧縮圖選擇 =====
+
+def score_frame_chunk(frames, previous):
+    """向量化計算一批灰階畫面的亮度、對比、清晰度與場景變化量"""
+    brightness = frames.mean(axis=(1, 2))
+    contrast = frames.std(axis=(1, 2))
+    sharpness = (np.abs(np.diff(frames, axis=1)).mean(axis=(1, 2)) +
+                 np.abs(np.diff(frames, axis=2)).mean(axis=(1, 2)))
+    shifted = np.concatenate([frames[:1] if previous is None else previous[None], frames[:-1]])
+    scene = np.abs(frames - shifted).mean(axis=(1, 2))
+    return np.stack([brightness, contrast, sharpness, scene], axis=1)
+
+def score_video_frames(video_path, duration):
+    """以單一 ffmpeg 管線串流解碼低解析度畫面並評分，回傳 (時間點, 分數)
+
+    畫面逐批讀入後立即評分丟棄，記憶體只保留每格四個數值，不產生暫存檔。
+    只解碼關鍵影格，每個關鍵影格一列分數，時間點取自關鍵影格索引；佔用磁碟
+    槽位的時間約等於讀檔時間，不會因全片解碼而拖慢同一磁碟上的其他請求。
+    """
+    if np is None or duration <= 0:
+        return None
+    index = get_keyframe_index(video_path)
+    if index is None:
+        return None
+
+    # 關鍵影格太密時每隔 step 個取一個，限制評分的畫面數
+    step = max(1, -(-len(index[0]) // SMART_THUMB_MAX_FRAMES))
+    keyframe_times = np.asarray(index[0], dtype=np.float64)[::step]
+    frame_bytes = SMART_THUMB_WIDTH * SMART_THUMB_HEIGHT
+    command = [
+        'ffmpeg', '-v', 'error',
+        '-skip_frame', 'nokey',
+        '-i', video_path,
+        '-an', '-sn',
+        '-vf', f'select=not(mod(n\\,{step})),scale={SMART_THUMB_WIDTH}:{SMART_THUMB_HEIGHT}',
+        '-vsync', 'passthrough',  # 不補幀，每個關鍵影格只輸出一次
+        '-f', 'rawvideo', '-pix_fmt', 'gray',
+        'pipe:1'
+    ]
+
+    measures = []
+    previous = None
+    with media_slot(video_path):
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            print(f"啟動 ffmpeg 失敗: {e}")
+            return None
+        try:
+            while True:
+                data = process.stdout.read(frame_bytes * SMART_THUMB_CHUNK)
+                count = len(data) // frame_bytes
+                if count == 0:
+                    break
+                frames = np.frombuffer(data[:count * frame_bytes], dtype=np.uint8)
+                frames = frames.reshape(count, SMART_THUMB_HEIGHT, SMART_THUMB_WIDTH).astype(np.float32)
+                measures.append(score_frame_chunk(frames, previous))
+                previous = frames[-1]
+        finally:
+            process.stdout.close()
+            process.wait()
+
+    if not measures:
+        return None
+    measures = np.concatenate(measures)
+    brightness, contrast, sharpness, scene = measures.T
+
+    # 亮度越接近中間調越好；過暗、過亮或接近單色的畫面（黑畫面、字卡）直接淘汰
+    brightness_score = 1 - np.abs(brightness - 128) / 128
+    contrast_score = np.clip(contrast / 64, 0, 1)
+    sharpness_score = sharpness / (sharpness.max() or 1)
+    scene_score = scene / (scene.max() or 1)
+    scores = (0.2 * brightness_score + 0.3 * contrast_score +
+              0.3 * sharpness_score + 0.2 * scene_score)
+    scores[(brightness < 20) | (brightness > 235) | (contrast < 10)] = 0
+
+    if len(scores) != len(keyframe_times):
+        # 解碼出的畫面數與索引不符（例如索引與解碼器對關鍵影格的判定不同），無法對應時間點
+        print(f"關鍵影格數不符 {video_path}: 索引 {len(keyframe_times)}，解碼 {len(scores)}")
+        return None
+    return keyframe_times, scores
+
+def select_representative_timestamps(video_path, count, duration=None):
+    """挑選 count 個分數最高且彼此相隔足夠遠的時間點，失敗時回傳 None"""
+    if duration is None:
+        duration = get_duration_seconds(video_path)
+    scored = score_video_frames(video_path, duration)
+    if scored is None:
+        return None
+    timestamps, scores = scored
+
+    min_gap = duration / (count * 2)
+    chosen = []
+    for i in np.argsort(scores)[::-1]:
+        if scores[i] <= 0:
+            break
+        if all(abs(timestamps[i] - t) >= min_gap for t in chosen):
+            chosen.append(float(timestamps[i]))
+            if len(chosen) == count:
+                break
+    return sorted(chosen) or None
+
+def get_thumbnail_path(video_path):
+    """影片預設縮圖的位置（與影片同目錄、同檔名的 .png）"""
     directory = os.path.dirname(video_path)
     base_name = os.path.splitext(os.path.basename(video_path))[0]
-    thumbnail_path = os.path.join(directory, base_name + '.png')
+    return os.path.join(directory, base_name + '.png')
+
+def generate_thumbnail(video_path):
+    thumbnail_path = get_thumbnail_path(video_path)
 
     if os.path.exists(thumbnail_path):
         return thumbnail_path  # 已有縮圖就直接用
 
+    # 挑選最具代表性的畫面；無法評分時取第 50 秒，短片則取中間
+    duration = get_duration_seconds(video_path)
+    selected = select_representative_timestamps(video_path, 1, duration)
+    if selected:
+        timestamp = selected[0]
+    else:
+        timestamp = 50 if duration <= 0 or duration > 100 else duration / 2
+
+    # 評分只看關鍵影格，選出的時間點直接對齊該關鍵影格
+    seek_args, _ = get_seek_args(video_path, timestamp, snap=bool(selected))
+    # 先寫入暫存檔再替換，避免 /api/thumbnail 或拼貼讀到寫到一半的圖片
+    tmp_path = thumbnail_path + '.tmp'
     command = [
         'ffmpeg',
         '-y',                 # 自動覆蓋舊檔（如果有的話）
+        *seek_args,
         '-i', video_path,
-        '-ss', '00:00:50',
         '-vframes', '1',
-        thumbnail_path
+        '-c:v', 'png', '-f', 'image2',
+        tmp_path
     ]
 
     try:
-        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if os.path.exists(thumbnail_path):
+        run_media_command(video_path, command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if os.path.exists(tmp_path):
+            os.replace(tmp_path, thumbnail_path)
             return thumbnail_path
     except subprocess.CalledProcessError:
-        pass
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
     return ""  # 如果產生失敗，回傳空字串
 
@@ -159,13 +792,15 @@ def generate_multi_thumbnails(video_path, timestamps=None, progress_callback=Non
     # 如果沒有指定時間點，使用預設的 10%, 30%, 50%, 70%, 90%
     if timestamps is None:
         # 先獲取影片總時長
+        duration = None
         try:
             # 使用當前目錄的FFprobe
             ffprobe_path = os.path.join(os.path.dirname(__file__), 'ffprobe.exe')
             if not os.path.exists(ffprobe_path):
                 ffprobe_path = 'ffprobe'  # 回退到系統PATH中的ffprobe
             
-            result = subprocess.run(
+            result = run_media_command(
+                video_path,
                 [ffprobe_path, '-v', 'error', '-show_entries',
                  'format=duration', '-of',
                  'default=noprint_wrappers=1:nokey=1', video_path],
@@ -173,7 +808,11 @@ def generate_multi_thumbnails(video_path, timestamps=None, progress_callback=Non
                 stderr=subprocess.STDOUT
             )
             duration = float(result.stdout)
-            # 生成 5 個時間點的縮圖
+            # 優先以畫面評分挑選 5 個代表性時間點，失敗時退回固定百分比
+            timestamps = select_representative_timestamps(video_path, 5, duration)
+        except Exception as e:
+            print(f"獲取影片時長失敗: {e}")
+        if duration and not timestamps:
             timestamps = [
                 duration * 0.1,   # 10%
                 duration * 0.3,   # 30% 
@@ -181,8 +820,7 @@ def generate_multi_thumbnails(video_path, timestamps=None, progress_callback=Non
                 duration * 0.7,   # 70%
                 duration * 0.9    # 90%
             ]
-        except Exception as e:
-            print(f"獲取影片時長失敗: {e}")
+        elif not duration:
             # 如果獲取時長失敗，使用固定秒數
             timestamps = [10, 30, 60, 90, 120]
     
@@ -209,11 +847,8 @@ def generate_multi_thumbnails(video_path, timestamps=None, progress_callback=Non
                 progress_callback(i+1, total_timestamps, f"第 {i+1} 個縮圖已存在，跳過生成")
             continue
         
-        # 將秒數轉換為 HH:MM:SS 格式
-        hours = int(timestamp // 3600)
-        minutes = int((timestamp % 3600) // 60)
-        seconds = int(timestamp % 60)
-        time_str = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+        # 透過關鍵影格索引直接跳到最近的關鍵影格
+        seek_args, timestamp = get_seek_args(video_path, float(timestamp))
         
         # 使用當前目錄的FFmpeg
         ffmpeg_path = os.path.join(os.path.dirname(__file__), 'ffmpeg.exe')
@@ -223,15 +858,15 @@ def generate_multi_thumbnails(video_path, timestamps=None, progress_callback=Non
         command = [
             ffmpeg_path,
             '-y',                 # 自動覆蓋舊檔
+            *seek_args,
             '-i', video_path,
-            '-ss', time_str,
             '-vframes', '1',
             '-vf', 'scale=320:180',  # 縮圖尺寸
             thumbnail_path
         ]
         
         try:
-            result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            result = run_media_command(video_path, command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             if os.path.exists(thumbnail_path):
                 thumbnails.append({
                     'path': thumbnail_path,
@@ -256,7 +891,8 @@ def get_video_info(video_path):
     """獲取影片詳細資訊"""
     try:
         # 獲取影片時長
-        duration_result = subprocess.run(
+        duration_result = run_media_command(
+            video_path,
             ['ffprobe', '-v', 'error', '-show_entries',
              'format=duration', '-of',
              'default=noprint_wrappers=1:nokey=1', video_path],
@@ -266,7 +902,8 @@ def get_video_info(video_path):
         duration_seconds = float(duration_result.stdout)
         
         # 獲取影片解析度
-        resolution_result = subprocess.run(
+        resolution_result = run_media_command(
+            video_path,
             ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
              '-show_entries', 'stream=width,height', '-of',
              'default=noprint_wrappers=1:nokey=1', video_path],
@@ -299,23 +936,1066 @@ def get_readable_size(size_bytes):
         size_bytes /= 1024
     return f"{size_bytes:.2f} PB"
 
+# ===== 縮圖延遲生成 =====
+# 掃描時不再產生縮圖；/api/thumbnail 第一次被請求時先回傳預設圖並排入佇列，
+# 同一部影片的並行請求共用同一個 ffmpeg 工作，失敗的影片在退避時間內不再重試。
+# 時長同樣不在掃描時讀取，而是掃描完成後在背景補上。
+
+thumbnail_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+thumbnail_jobs = {}
+thumbnail_failures = {}   # 影片路徑 -> (失敗次數, 下次可重試的時間)
+thumbnail_lock = threading.Lock()
+
+def finish_thumbnail_job(video_path, future):
+    try:
+        succeeded = bool(future.result())
+    except Exception as e:
+        print(f"生成縮圖失敗 {video_path}: {e}")
+        succeeded = False
+    with thumbnail_lock:
+        thumbnail_jobs.pop(video_path, None)
+        if succeeded:
+            thumbnail_failures.pop(video_path, None)
+        else:
+            failures = thumbnail_failures.get(video_path, (0, 0))[0] + 1
+            delay = min(THUMBNAIL_RETRY_BASE * 2 ** (failures - 1), THUMBNAIL_RETRY_MAX)
+            thumbnail_failures[video_path] = (failures, time.time() + delay)
+
+def request_thumbnail(video_path):
+    """排入縮圖生成工作，回傳狀態：pending（生成中）或 failed（退避中）"""
+    with thumbnail_lock:
+        if video_path in thumbnail_jobs:
+            return 'pending'
+        failure = thumbnail_failures.get(video_path)
+        if failure and time.time() < failure[1]:
+            return 'failed'
+        future = thumbnail_executor.submit(generate_thumbnail, video_path)
+        thumbnail_jobs[video_path] = future
+    future.add_done_callback(lambda f: finish_thumbnail_job(video_path, f))
+    return 'pending'
+
+duration_pending = set()
+
+def fill_video_durations(paths):
+    """在背景依儲存裝置排程讀取時長，完成後一次寫回 data.json"""
+    try:
+        durations = run_media_jobs(paths, get_video_duration)
+        known = {path: duration for path, duration in durations.items() if duration and duration != "未知"}
+        if known:
+            with data_file_lock:
+                videos = load_videos()
+                for video in videos:
+                    if video['path'] in known:
+                        video['duration'] = known[video['path']]
+                save_videos(videos)
+    except Exception as e:
+        print(f"讀取影片時長失敗: {e}")
+    finally:
+        with thumbnail_lock:
+            duration_pending.difference_update(paths)
+
+def request_durations(paths):
+    """排入背景時長讀取，已在佇列中的影片不重複排入，回傳實際排入的數量"""
+    with thumbnail_lock:
+        paths = [path for path in paths if path not in duration_pending]
+        duration_pending.update(paths)
+    if paths:
+        threading.Thread(target=fill_video_durations, args=(paths,), daemon=True).start()
+    return len(paths)
+
+def find_video_for_thumbnail(thumbnail_path):
+    """由預設縮圖路徑反查目錄中的影片路徑"""
+    base = os.path.splitext(thumbnail_path)[0]
+    path_index = get_catalog().path_index
+    for ext in ('.mp4', '.mkv', '.avi', '.mov', '.MP4', '.MKV', '.AVI', '.MOV'):
+        if base + ext in path_index:
+            return base + ext
+    return None
+
+# ===== 縮圖拼貼 =====
+# 將一頁列表的縮圖縮小後拼成單張 JPEG，並回傳每部影片在拼貼圖中的位置。
+# 拼貼圖的鍵值包含每張縮圖的路徑、大小與修改時間，任何一張變動都會產生新圖。
+
+def get_file_signature(path):
+    stat = os.stat(path)
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def get_tile_image(image_path, width, height):
+    """取得縮小後的縮圖（快取於 cache/tiles），回傳 PIL Image"""
+    key = hashlib.sha1(f"{get_file_signature(image_path)}|{width}x{height}".encode('utf-8')).hexdigest()
+    tile_path = os.path.join(TILE_CACHE_DIR, key + '.jpg')
+    if os.path.exists(tile_path):
+        # 讀入記憶體後立即關閉檔案，避免佔用檔案代碼（Windows 上也會擋住快取清理）
+        with Image.open(tile_path) as cached:
+            return cached.copy()
+
+    with Image.open(image_path) as source:
+        source.draft('RGB', (width, height))  # JPEG 可直接以低解析度解碼
+        tile = ImageOps.fit(source.convert('RGB'), (width, height))
+    os.makedirs(TILE_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{tile_path}.{uuid.uuid4().hex}.tmp"
+    tile.save(tmp_path, 'JPEG', quality=SPRITE_JPEG_QUALITY)
+    os.replace(tmp_path, tile_path)
+    return tile
+
+def prune_file_cache(directory, max_files):
+    """快取目錄（拼貼圖、縮小後的縮圖）超過檔案數上限時刪除最舊的檔案"""
+    try:
+        entries = [os.path.join(directory, name) for name in os.listdir(directory)
+                   if not name.endswith('.tmp')]
+    except OSError:
+        return
+    if len(entries) <= max_files:
+        return
+    mtimes = {}
+    for path in entries:
+        try:
+            mtimes[path] = os.path.getmtime(path)
+        except OSError:
+            pass  # 已被其他請求刪除
+    entries = sorted(mtimes, key=mtimes.get)
+    for path in entries[:len(entries) - max_files]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def build_thumbnail_sprite(members, width, height):
+    """為 [(影片索引, 影片路徑, 縮圖路徑)] 建立拼貼圖，回傳版面資訊
+
+    縮圖尚未生成的影片會排入延遲生成並以預設圖佔位，標記在 pending 中。
+    """
+    sources = []
+    pending = []
+    for index, video_path, thumb_path in members:
+        if not thumb_path or not os.path.exists(thumb_path):
+            thumb_path = get_thumbnail_path(video_path)
+        if os.path.exists(thumb_path):
+            sources.append(thumb_path)
+        else:
+            if os.path.exists(video_path):
+                request_thumbnail(video_path)
+            sources.append(DEFAULT_THUMBNAIL)
+            pending.append(index)
+
+    columns = max(1, min(SPRITE_MAX_COLUMNS, len(members)))
+    rows = (len(members) + columns - 1) // columns
+    signature = '|'.join(get_file_signature(path) for path in sources)
+    key = hashlib.sha1(f"{width}x{height}|{signature}".encode('utf-8')).hexdigest()
+    sprite_path = os.path.join(SPRITE_CACHE_DIR, key + '.jpg')
+
+    if not os.path.exists(sprite_path):
+        sprite = Image.new('RGB', (columns * width, rows * height))
+        for position, source in enumerate(sources):
+            try:
+                tile = get_tile_image(source, width, height)
+            except OSError as e:
+                print(f"讀取縮圖失敗 {source}: {e}")
+                continue
+            sprite.paste(tile, ((position % columns) * width, (position // columns) * height))
+        os.makedirs(SPRITE_CACHE_DIR, exist_ok=True)
+        # 同一拼貼圖可能被並行請求同時建立，各自使用獨立的暫存檔
+        tmp_path = f"{sprite_path}.{uuid.uuid4().hex}.tmp"
+        sprite.save(tmp_path, 'JPEG', quality=SPRITE_JPEG_QUALITY)
+        os.replace(tmp_path, sprite_path)
+        # 縮圖變動後舊的拼貼圖與縮小圖不會再被使用，建立新圖時一併清理
+        prune_file_cache(SPRITE_CACHE_DIR, SPRITE_CACHE_MAX_FILES)
+        prune_file_cache(TILE_CACHE_DIR, TILE_CACHE_MAX_FILES)
+
+    tiles = {}
+    for position, (index, _, _) in enumerate(members):
+        tiles[index] = {'x': (position % columns) * width, 'y': (position // columns) * height}
+    return {
+        'key': key,
+        'tile_width': width,
+        'tile_height': height,
+        'columns': columns,
+        'rows': rows,
+        'tiles': tiles,
+        'pending': pending
+    }
+
+# ===== 影片庫健康檢查 =====
+# 逐一 os.path.exists 在磁碟或網路磁碟機離線時會卡住，或讓整個磁碟區的影片被當成
+# 不存在而刪除。這裡先依磁碟區分組，每個磁碟區以逾時探測一次，只對線上的磁碟區
+# 平行 stat，離線磁碟區上的影片一律保留。
+
+health_cache = {'checked_at': 0, 'summary': None}
+
+def get_volume_root(path, mount_cache=None):
+    """取得影片所在的磁碟區：Windows 磁碟機或 UNC 分享，POSIX 則為實際掛載點
+
+    掛載點需在檔案可存取時判斷（卸載後會往上找到 /），因此掃描時會記錄在
+    影片的 volume 欄位，之後的健康檢查優先使用記錄值。mount_cache 為
+    {目錄: 掛載點}，同一批路徑共用以免每個檔案都重新往上 stat。
+    """
+    drive, rest = os.path.splitdrive(path)
+    if drive:
+        return drive.upper() + '\\'
+    if len(path) > 2 and path[1] == ':':
+        # 在非 Windows 主機上讀到 Windows 路徑
+        return path[:2].upper() + '\\'
+    if path.startswith('\\\\'):
+        parts = path[2:].split('\\')
+        return '\\\\' + '\\'.join(parts[:2]) + '\\'
+    parts = path.split('/')
+    for parent in MOUNT_PARENTS:
+        depth = parent.count('/') + 1
+        if path.startswith(parent + '/'):
+            # /media 與 /run/media 下還有一層使用者名稱
+            if parent in ('/media', '/run/media') and len(parts) > depth + 1:
+                depth += 1
+            return '/'.join(parts[:depth + 1])
+    # 其他路徑（例如掛在 /data/nas 的網路分享）往上找到實際掛載點
+    if mount_cache is None:
+        mount_cache = {}
+    visited = []
+    mount = os.path.dirname(path)
+    while mount and mount not in mount_cache and not os.path.ismount(mount):
+        visited.append(mount)
+        parent = os.path.dirname(mount)
+        if parent == mount:
+            break
+        mount = parent
+    root = mount_cache.get(mount, mount) or '/'
+    for directory in visited + [mount]:
+        mount_cache[directory] = root
+    return root
+
+def resolve_volume_roots(paths, timeout=VOLUME_PROBE_TIMEOUT):
+    """在逾時內判斷一批影片的磁碟區，回傳 {路徑: 磁碟區}
+
+    往上找掛載點需要 stat，卸載中或卡住的網路磁碟機可能讓它無限期阻塞；
+    逾時仍未判斷的影片不在回傳結果中，由呼叫端當作離線處理。
+    """
+    roots = {}
+    mount_cache = {}
+
+    def target():
+        for path in paths:
+            roots[path] = get_volume_root(path, mount_cache)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return dict(roots)
+
+def is_volume_online(root):
+    """判斷磁碟區是否可用；未掛載的外接裝置目錄可能仍存在，因此要求是掛載點"""
+    if root == '/' or root.endswith('\\'):
+        return os.path.isdir(root)
+    return os.path.ismount(root)
+
+def probe_volume(root, timeout=VOLUME_PROBE_TIMEOUT):
+    """在逾時內探測磁碟區，逾時視為離線（網路磁碟機斷線時 stat 可能卡住數十秒）"""
+    result = {}
+
+    def target():
+        try:
+            result['online'] = is_volume_online(root)
+        except OSError:
+            result['online'] = False
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return result.get('online', False)
+
+def check_library_health(paths, recorded=None):
+    """回傳 {'volumes': {磁碟區: 統計}, 'missing': set, 'offline': set}
+
+    recorded 為掃描時記錄的 {影片路徑: 磁碟區}，沒有記錄的影片在逾時內即時判斷；
+    回傳值的 roots 為每部影片的磁碟區，供掃描時補記 volume 欄位。
+    """
+    started = time.time()
+    recorded = recorded or {}
+    roots = resolve_volume_roots([path for path in paths if not recorded.get(path)])
+    groups = OrderedDict()
+    unresolved = set()
+    for path in paths:
+        root = recorded.get(path) or roots.get(path)
+        if root is None:
+            # 判斷磁碟區逾時：以所在目錄分組並直接視為離線，不再 stat
+            root = os.path.dirname(path) or '/'
+            unresolved.add(root)
+        roots[path] = root
+        groups.setdefault(root, []).append(path)
+
+    volumes = {}
+    online_paths = []
+    offline = set()
+    with ThreadPoolExecutor(max_workers=max(1, min(HEALTH_STAT_WORKERS, len(groups)))) as pool:
+        probes = {root: pool.submit(probe_volume, root) for root in groups if root not in unresolved}
+        for root in groups:
+            online = probes[root].result() if root in probes else False
+            volumes[root] = {'volume': root, 'online': online, 'total': len(groups[root]), 'missing': 0}
+            if online:
+                online_paths.extend(groups[root])
+            else:
+                offline.update(groups[root])
+
+    missing = set()
+    if online_paths:
+        checked = set()
+        pool = ThreadPoolExecutor(max_workers=HEALTH_STAT_WORKERS)
+        try:
+            for path, exists in zip(online_paths, pool.map(os.path.exists, online_paths,
+                                                           timeout=HEALTH_STAT_TIMEOUT)):
+                checked.add(path)
+                if not exists:
+                    missing.add(path)
+                    volumes[roots[path]]['missing'] += 1
+        except FuturesTimeoutError:
+            # stat 太慢時保守處理：尚未確認的影片當作離線，不刪除
+            for path in online_paths:
+                if path not in checked:
+                    offline.add(path)
+                    volumes[roots[path]]['online'] = False
+        finally:
+            pool.shutdown(wait=False)
+
+    # 整個磁碟區的影片都不見時，較可能是分享或裝置未掛載而非全部被刪除
+    for root, group in groups.items():
+        if volumes[root]['online'] and group and all(path in missing for path in group):
+            missing.difference_update(group)
+            offline.update(group)
+            volumes[root].update({'online': False, 'missing': 0, 'suspect': True})
+
+    return {
+        'volumes': volumes,
+        'roots': {path: root for path, root in roots.items() if root not in unresolved},
+        'missing': missing,
+        'offline': offline,
+        'elapsed': round(time.time() - started, 3)
+    }
+
+# ===== 批次轉檔 =====
+# 依標籤或關鍵字挑選影片，以 CPU 預設在背景轉檔。每個檔案的狀態都寫入
+# transcode_state.json，中斷後恢復時跳過已完成的檔案；輸出通過時長與
+# 串流數驗證後，才以原子替換方式更新 data.json 中的影片路徑。
+
+transcode_jobs = {}
+transcode_lock = threading.Lock()
+transcode_state = {'loaded': False}
+transcode_device_slots = {}
+
+def get_transcode_slot(path):
+    """轉檔專用的裝置名額：長時間轉檔不佔用 media_slot，避免預覽、字幕等請求排隊數小時"""
+    device = get_storage_device(path)
+    with media_device_lock:
+        if device not in transcode_device_slots:
+            transcode_device_slots[device] = threading.BoundedSemaphore(TRANSCODE_DEVICE_CONCURRENCY)
+        return transcode_device_slots[device]
+
+def get_transcode_workers():
+    """依 CPU 核心數與實體記憶體決定同時轉檔的數量"""
+    workers = max(1, (os.cpu_count() or 1) // TRANSCODE_THREADS_PER_JOB)
+    try:
+        memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        workers = min(workers, max(1, memory // TRANSCODE_MEMORY_PER_JOB))
+    except (AttributeError, ValueError, OSError):
+        pass  # Windows 沒有 sysconf，只依核心數限制
+    return workers
+
+def load_transcode_state():
+    """載入轉檔檢查點（需持有 transcode_lock）；執行中的檔案視為中斷"""
+    if transcode_state['loaded']:
+        return
+    if os.path.exists(TRANSCODE_STATE_FILE):
+        with open(TRANSCODE_STATE_FILE, 'r', encoding='utf-8') as f:
+            transcode_jobs.update(json.load(f))
+        for job in transcode_jobs.values():
+            if job['status'] == 'running':
+                job['status'] = 'interrupted'
+            for item in job['files'].values():
+                if item['status'] == 'running':
+                    item['status'] = 'pending'
+    transcode_state['loaded'] = True
+
+def save_transcode_state():
+    """寫入轉檔檢查點（需持有 transcode_lock）"""
+    tmp_path = TRANSCODE_STATE_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(transcode_jobs, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, TRANSCODE_STATE_FILE)
+
+def update_transcode_file(job_id, path, **fields):
+    with transcode_lock:
+        transcode_jobs[job_id]['files'][path].update(fields)
+        if 'status' in fields:
+            save_transcode_state()
+
+def count_streams(video_path):
+    """回傳各類型串流數量，另附字幕編碼清單，例如 {'video': 1, 'audio': 2, 'subtitle_codecs': [...]}"""
+    result = run_media_command(
+        video_path,
+        ['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,codec_name',
+         '-of', 'json', video_path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+    streams = json.loads(result.stdout or b'{}').get('streams', [])
+    counts = {'video': 0, 'audio': 0, 'subtitle': 0, 'attachment': 0, 'subtitle_codecs': []}
+    for stream in streams:
+        codec_type = stream.get('codec_type')
+        if codec_type in counts:
+            counts[codec_type] += 1
+        if codec_type == 'subtitle':
+            counts['subtitle_codecs'].append(stream.get('codec_name', ''))
+    return counts
+
+def get_unsupported_streams(streams):
+    """列出無法原樣帶到 MP4 輸出的串流，回傳說明字串（可轉檔時為空字串）
+
+    文字字幕會轉成 mov_text 保留；圖形字幕、附件（例如 MKV 內嵌字型）與
+    多條視訊串流（例如封面圖）無法保留，轉檔並刪除原檔會造成資料遺失。
+    資料串流（時間碼等）不含內容，不列入檢查。
+    """
+    problems = []
+    image_subtitles = [codec for codec in streams['subtitle_codecs'] if codec not in TEXT_SUBTITLE_CODECS]
+    if image_subtitles:
+        problems.append(f"圖形字幕 {', '.join(image_subtitles)}")
+    if streams['attachment']:
+        problems.append(f"{streams['attachment']} 個附件")
+    if streams['video'] != 1:
+        problems.append(f"{streams['video']} 條視訊串流")
+    return '、'.join(problems)
+
+def get_transcode_target(video_path, delete_source):
+    """決定輸出路徑；不會選到已存在或已在影片庫中的其他檔案"""
+    base, ext = os.path.splitext(video_path)
+    if ext == '.mp4' and delete_source:
+        return video_path  # 原地取代來源
+    path_index = get_catalog().path_index
+    candidates = [base + '.mp4'] if ext.lower() != '.mp4' else []
+    candidates.append(base + '_transcoded.mp4')
+    candidates.extend(f'{base}_transcoded_{n}.mp4' for n in range(2, 100))
+    for candidate in candidates:
+        if not os.path.exists(candidate) and candidate not in path_index:
+            return candidate
+    return None
+
+def replace_catalog_path(old_path, new_path, keep_source):
+    """以原子替換方式更新 data.json 中影片的路徑、檔名與大小
+
+    保留原檔時記錄於 transcoded_from，掃描時不會再把原檔加回影片庫。
+    """
+    with data_file_lock:
+        videos = load_videos()
+        for video in videos:
+            if video['path'] == old_path:
+                if video.get('filename') == os.path.basename(old_path):
+                    video['filename'] = os.path.basename(new_path)
+                video['path'] = new_path
+                video['size'] = get_readable_size(os.path.getsize(new_path))
+                if keep_source and new_path != old_path:
+                    video['transcoded_from'] = old_path
+        save_videos(videos)
+
+def transcode_file(job_id, video_path):
+    """轉檔單一影片並驗證輸出，成功時替換目錄中的路徑"""
+    with transcode_lock:
+        job = transcode_jobs[job_id]
+        preset = job['preset']
+        delete_source = job['delete_source']
+    update_transcode_file(job_id, video_path, status='running', started_at=time.time())
+
+    source_size = os.path.getsize(video_path)
+    source_duration = get_duration_seconds(video_path)
+    source_streams = count_streams(video_path)
+    unsupported = get_unsupported_streams(source_streams)
+    if unsupported:
+        update_transcode_file(job_id, video_path, status='skipped', error=f'含有無法保留的串流：{unsupported}')
+        return
+    target = get_transcode_target(video_path, delete_source)
+    if target is None:
+        update_transcode_file(job_id, video_path, status='skipped', error='找不到可用的輸出檔名')
+        return
+    # 暫存檔的副檔名不在掃描清單內，轉檔途中掃描不會把它加入影片庫
+    tmp_target = target + '.transcoding'
+
+    command = ['ffmpeg', '-v', 'error', '-y', '-nostats', '-progress', 'pipe:1',
+               '-i', video_path, '-map', '0:v:0', '-map', '0:a?', '-map', '0:s?',
+               '-threads', str(TRANSCODE_THREADS_PER_JOB),
+               *TRANSCODE_PRESETS[preset], '-c:s', 'mov_text',
+               '-movflags', '+faststart', '-f', 'mp4', tmp_target]
+    frames = 0
+    with get_transcode_slot(video_path):
+        started = time.time()  # 取得名額後才計時，耗時與 fps 不含排隊時間
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        for line in process.stdout:
+            key, _, value = line.decode(errors='ignore').strip().partition('=')
+            if key == 'frame' and value.isdigit():
+                frames = int(value)
+            elif key == 'out_time_us' and value.isdigit() and source_duration:
+                with transcode_lock:
+                    transcode_jobs[job_id]['files'][video_path]['progress'] = round(
+                        min(int(value) / 1e6 / source_duration, 1.0) * 100, 1)
+        returncode = process.wait()
+    elapsed = time.time() - started
+
+    def fail(reason):
+        if os.path.exists(tmp_target):
+            os.remove(tmp_target)
+        update_transcode_file(job_id, video_path, status='failed', error=reason, elapsed=round(elapsed, 1))
+
+    if returncode != 0 or not os.path.exists(tmp_target):
+        return fail(f'ffmpeg 結束代碼 {returncode}')
+
+    # 驗證時長與串流數，避免以損壞的輸出取代原檔
+    output_duration = get_duration_seconds(tmp_target)
+    if abs(output_duration - source_duration) > TRANSCODE_DURATION_TOLERANCE:
+        return fail(f'時長不符：來源 {source_duration:.1f}s，輸出 {output_duration:.1f}s')
+    output_streams = count_streams(tmp_target)
+    if any(output_streams[kind] != source_streams[kind] for kind in ('video', 'audio', 'subtitle')):
+        return fail(f'串流數不符：來源 {source_streams}，輸出 {output_streams}')
+
+    output_size = os.path.getsize(tmp_target)
+    if output_size >= source_size:
+        os.remove(tmp_target)
+        update_transcode_file(job_id, video_path, status='skipped', error='輸出沒有比原檔小',
+                              elapsed=round(elapsed, 1))
+        return
+
+    # 轉檔期間目標可能被其他程式建立，不覆蓋來源以外的既有檔案
+    if target != video_path and os.path.exists(target):
+        return fail(f'輸出檔已存在：{target}')
+    os.replace(tmp_target, target)
+    replace_catalog_path(video_path, target, keep_source=not delete_source)
+    if delete_source and target != video_path:
+        os.remove(video_path)
+    update_transcode_file(
+        job_id, video_path,
+        status='done',
+        output=target,
+        progress=100,
+        elapsed=round(elapsed, 1),
+        fps=round(frames / elapsed, 1) if elapsed > 0 else 0,
+        bytes_saved=source_size - output_size
+    )
+
+def run_transcode_job(job_id):
+    """在背景執行批次轉檔，跳過檢查點中已完成的檔案"""
+    with transcode_lock:
+        job = transcode_jobs[job_id]
+        job['status'] = 'running'
+        pending = [path for path, item in job['files'].items()
+                   if item['status'] in ('pending', 'failed')]
+        save_transcode_state()
+
+    def worker(path):
+        try:
+            transcode_file(job_id, path)
+        except Exception as e:
+            update_transcode_file(job_id, path, status='failed', error=str(e))
+
+    with ThreadPoolExecutor(max_workers=get_transcode_workers()) as pool:
+        list(pool.map(worker, pending))
+
+    with transcode_lock:
+        job['status'] = 'finished'
+        save_transcode_state()
+
+def start_transcode_job(job_id):
+    threading.Thread(target=run_transcode_job, args=(job_id,), daemon=True).start()
+
+def summarize_transcode_job(job):
+    files = job['files'].values()
+    done = [item for item in files if item['status'] == 'done']
+    counts = {}
+    for item in files:
+        counts[item['status']] = counts.get(item['status'], 0) + 1
+    return {
+        **job,
+        'counts': counts,
+        'bytes_saved': sum(item.get('bytes_saved', 0) for item in done),
+        'readable_saved': get_readable_size(sum(item.get('bytes_saved', 0) for item in done))
+    }
+
+# ===== 預覽片段 =====
+# 以單一 ffmpeg 對同一檔案開多個輸入，每個輸入在 -i 之前 seek 到關鍵影格，
+# 只解碼 1 秒後以 concat 串接，輸出幾百 KB 的靜音片段。快取依最近使用時間淘汰。
+
+preview_locks = {}
+preview_lock = threading.Lock()
+
+def get_preview_segment_times(duration):
+    """在時間軸上平均挑選片段起點，避開片頭片尾"""
+    count = PREVIEW_SEGMENTS if duration >= PREVIEW_SEGMENTS * 2 else max(1, int(duration // 2))
+    return [duration * (i + 0.5) / count for i in range(count)]
+
+def prune_preview_cache():
+    """預覽快取超過容量上限時，刪除最久未使用的片段
+
+    在 preview_lock 下執行避免並行清理；檔案可能已被刪除，或在 Windows 上
+    仍在傳送中而無法刪除，逐檔忽略 OSError。
+    """
+    with preview_lock:
+        try:
+            names = [name for name in os.listdir(PREVIEW_CACHE_DIR) if not name.endswith('.tmp')]
+        except OSError:
+            return
+        entries = []
+        for name in names:
+            path = os.path.join(PREVIEW_CACHE_DIR, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        recent = time.time() - PREVIEW_PRUNE_GRACE
+        for mtime, size, path in entries:
+            if total <= PREVIEW_CACHE_MAX_BYTES or mtime >= recent:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+def build_preview_clip(video_path, fmt, clip_path):
+    """執行 ffmpeg 生成預覽片段，成功時回傳 True"""
+    duration = get_duration_seconds(video_path)
+    if duration <= 0:
+        return False
+    command = ['ffmpeg', '-v', 'error', '-y']
+    filters = []
+    times = get_preview_segment_times(duration)
+    for i, timestamp in enumerate(times):
+        seek_args, _ = get_seek_args(video_path, timestamp)
+        command += [*seek_args, '-t', str(PREVIEW_SEGMENT_SECONDS), '-i', video_path]
+        filters.append(f'[{i}:v:0]scale={PREVIEW_WIDTH}:-2,fps={PREVIEW_FPS},setsar=1[v{i}]')
+    concat_inputs = ''.join(f'[v{i}]' for i in range(len(times)))
+    filters.append(f'{concat_inputs}concat=n={len(times)}:v=1:a=0[out]')
+
+    os.makedirs(PREVIEW_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{clip_path}.{uuid.uuid4().hex}.tmp"  # 鎖釋放後仍可能有並行重建，各用各的暫存檔
+    command += ['-filter_complex', ';'.join(filters), '-map', '[out]', '-an',
+                *PREVIEW_FORMATS[fmt], tmp_path]
+    result = run_media_command(video_path, command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0 or not os.path.exists(tmp_path):
+        print(f"生成預覽片段失敗 {video_path}: {result.stderr.decode(errors='ignore')[-300:]}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, clip_path)
+    return True
+
+def generate_preview_clip(video_path, fmt='mp4'):
+    """產生（或取用快取的）預覽片段，回傳檔案路徑，失敗時回傳空字串"""
+    clip_path = os.path.join(PREVIEW_CACHE_DIR, f"{get_media_cache_key(video_path)}.{fmt}")
+    # 快取命中：修改時間即最近使用時間，只在超過清理保護期一半時才更新，
+    # 避免每個 Range 請求都改動傳送中檔案的 Last-Modified 與 ETag
+    try:
+        if time.time() - os.path.getmtime(clip_path) > PREVIEW_PRUNE_GRACE / 2:
+            os.utime(clip_path)
+        return clip_path
+    except OSError:
+        pass  # 尚未生成或剛被清理，重新生成
+
+    with preview_lock:
+        lock = preview_locks.setdefault(clip_path, threading.Lock())
+    try:
+        # 同一片段的並行請求只跑一次 ffmpeg
+        with lock:
+            if not os.path.exists(clip_path) and not build_preview_clip(video_path, fmt, clip_path):
+                return ""
+    finally:
+        with preview_lock:
+            preview_locks.pop(clip_path, None)
+
+    prune_preview_cache()
+    return clip_path
+
+# ===== 記憶體目錄 =====
+# data.json 的每筆影片都是一個字串字典，相同的長目錄前綴在 path、thumbnail、
+# multi_thumbnails、subtitles 中重複出現。這裡改以欄位陣列保存：目錄字串只存
+# 一次，每筆只記目錄編號與檔名；大小、時長、加入時間存成數值欄位，
+# 只有在 API 回應時才還原成原本的字典格式。
+
+def split_path(path):
+    """切出目錄前綴（含分隔符）與檔名，同時支援 Windows 與 POSIX 路徑"""
+    cut = max(path.rfind('\\'), path.rfind('/')) + 1
+    return path[:cut], path[cut:]
+
+def parse_readable_size(text):
+    """將 get_readable_size 的輸出還原為位元組數，無法解析時回傳 None"""
+    try:
+        value, unit = text.split()
+        return int(round(float(value) * 1024 ** SIZE_UNITS[unit]))
+    except (AttributeError, ValueError, KeyError):
+        return None
+
+def parse_duration(text):
+    """將 "分:秒" 還原為秒數，無法解析時回傳 None"""
+    try:
+        mins, secs = text.split(':')
+        return int(mins) * 60 + int(secs)
+    except (AttributeError, ValueError):
+        return None
+
+def format_duration(seconds):
+    mins = int(seconds // 60)
+    secs = int(seconds % 60)
+    return f"{mins}:{secs:02d}"
+
+def parse_add_time(text):
+    try:
+        return datetime.datetime.strptime(text, ADD_TIME_FORMAT).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+class DirectoryTable:
+    """共用的目錄字串表，每個目錄前綴只保存一次"""
+    __slots__ = ('paths', 'ids')
+
+    def __init__(self):
+        self.paths = []
+        self.ids = {}
+
+    def intern(self, path):
+        """回傳 (目錄編號, 檔名)"""
+        directory, name = split_path(path)
+        dir_id = self.ids.get(directory)
+        if dir_id is None:
+            dir_id = len(self.paths)
+            self.paths.append(directory)
+            self.ids[directory] = dir_id
+        return dir_id, name
+
+    def join(self, dir_id, name):
+        return self.paths[dir_id] + name
+
+class Catalog:
+    """以欄位陣列保存的影片目錄，索引與 data.json 中的順序一致"""
+    __slots__ = ('dirs', 'dir_ids', 'names', 'filenames', 'tags', 'descriptions',
+                 'sizes', 'durations', 'add_times', 'thumb_dir_ids', 'thumb_names',
+                 'extras', 'path_index')
+
+    def __init__(self, videos):
+        self.dirs = DirectoryTable()
+        self.dir_ids = array.array('l')
+        self.names = []
+        self.filenames = []         # 與檔名相同時存 None
+        self.tags = []
+        self.descriptions = []
+        self.sizes = array.array('q')       # 位元組，-1 代表未知
+        self.durations = array.array('d')   # 秒，NaN 代表未知
+        self.add_times = array.array('d')   # Unix 時間，NaN 代表未知
+        self.thumb_dir_ids = array.array('l')  # -1 代表沒有縮圖
+        self.thumb_names = []
+        self.extras = []            # 其他少見欄位，或無法轉成數值的原始值
+        self.path_index = {}
+        for video in videos:
+            self.append(video)
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern_value(self, value):
+        """將清單欄位中的 path 轉為 (目錄編號, 檔名)"""
+        if isinstance(value, list):
+            return [self.intern_value(item) for item in value]
+        if isinstance(value, dict) and isinstance(value.get('path'), str):
+            item = dict(value)
+            item['path'] = self.dirs.intern(value['path'])
+            return item
+        return value
+
+    def restore_value(self, value):
+        if isinstance(value, list):
+            return [self.restore_value(item) for item in value]
+        if isinstance(value, dict) and isinstance(value.get('path'), tuple):
+            item = dict(value)
+            item['path'] = self.dirs.join(*value['path'])
+            return item
+        return value
+
+    def append(self, video):
+        extras = {}
+        dir_id, name = self.dirs.intern(video.get('path', ''))
+        self.path_index[video.get('path', '')] = len(self.names)
+        self.dir_ids.append(dir_id)
+        self.names.append(name)
+
+        filename = video.get('filename', name)
+        self.filenames.append(None if filename == name else filename)
+        tags = video.get('tag', [])
+        if isinstance(tags, list):
+            self.tags.append(tuple(sys.intern(str(tag)) for tag in tags))
+        else:
+            self.tags.append(())
+            extras['tag'] = tags
+        self.descriptions.append(video.get('description', ''))
+
+        size = parse_readable_size(video.get('size'))
+        self.sizes.append(-1 if size is None else size)
+        duration = parse_duration(video.get('duration'))
+        self.durations.append(math.nan if duration is None else duration)
+        add_time = parse_add_time(video.get('add_time'))
+        self.add_times.append(math.nan if add_time is None else add_time)
+        # 無法還原成相同字串的值原樣保留
+        for key, parsed in (('size', size), ('duration', duration), ('add_time', add_time)):
+            if parsed is None and key in video:
+                extras[key] = video[key]
+
+        thumbnail = video.get('thumbnail') or ''
+        if thumbnail:
+            thumb_dir_id, thumb_name = self.dirs.intern(thumbnail)
+        else:
+            thumb_dir_id, thumb_name = -1, ''
+            if 'thumbnail' not in video:
+                extras['thumbnail'] = None
+        self.thumb_dir_ids.append(thumb_dir_id)
+        self.thumb_names.append(sys.intern(thumb_name))
+
+        for key, value in video.items():
+            if key not in CATALOG_FIELDS:
+                extras[key] = self.intern_value(value) if key in CATALOG_PATH_LIST_FIELDS else value
+        self.extras.append(extras or None)
+
+    def path(self, i):
+        return self.dirs.join(self.dir_ids[i], self.names[i])
+
+    def materialize(self, i):
+        """將第 i 筆還原成 data.json 的字典格式"""
+        thumb_dir_id = self.thumb_dir_ids[i]
+        video = {
+            'filename': self.filenames[i] or self.names[i],
+            'tag': list(self.tags[i]),
+            'path': self.path(i),
+            'description': self.descriptions[i],
+            'duration': '未知' if math.isnan(self.durations[i]) else format_duration(self.durations[i]),
+            'thumbnail': self.dirs.join(thumb_dir_id, self.thumb_names[i]) if thumb_dir_id >= 0 else '',
+            'size': get_readable_size(self.sizes[i]) if self.sizes[i] >= 0 else '未知',
+            'add_time': (datetime.datetime.fromtimestamp(self.add_times[i]).strftime(ADD_TIME_FORMAT)
+                         if not math.isnan(self.add_times[i]) else '')
+        }
+        extras = self.extras[i]
+        if extras:
+            for key, value in extras.items():
+                if value is None and key == 'thumbnail':
+                    del video['thumbnail']
+                else:
+                    video[key] = self.restore_value(value)
+        return video
+
+    def query(self, tags=None, search=None, sort=None, reverse=False):
+        """依標籤（任一符合）與關鍵字篩選，回傳排序後的索引清單"""
+        indices = range(len(self))
+        if tags:
+            wanted = set(tags)
+            indices = [i for i in indices if not wanted.isdisjoint(self.tags[i])]
+        if search:
+            term = search.lower()
+            indices = [i for i in indices
+                       if term in (self.filenames[i] or self.names[i]).lower()
+                       or term in (self.descriptions[i] or '').lower()
+                       or term in ' '.join(self.tags[i]).lower()]
+        indices = list(indices)
+
+        if sort == 'filename':
+            indices.sort(key=lambda i: (self.filenames[i] or self.names[i]).lower(), reverse=reverse)
+        elif sort in ('size', 'duration', 'add_time'):
+            column = {'size': self.sizes, 'duration': self.durations, 'add_time': self.add_times}[sort]
+            # 未知值一律排在最後
+            known, unknown = [], []
+            for i in indices:
+                (unknown if column[i] < 0 or math.isnan(column[i]) else known).append(i)
+            known.sort(key=column.__getitem__, reverse=reverse)
+            indices = known + unknown
+        return indices
+
+catalog_cache = {'signature': None, 'catalog': None}
+catalog_lock = threading.Lock()
+
+def get_catalog():
+    """獲取記憶體目錄，data.json 有變動時自動重建"""
+    stat = os.stat(DATA_FILE)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with catalog_lock:
+        if catalog_cache['signature'] != signature:
+            with open(DATA_FILE, 'r', encoding='utf-8') as f:
+                catalog_cache['catalog'] = Catalog(json.load(f))
+            catalog_cache['signature'] = signature
+        return catalog_cache['catalog']
+
+# ===== 播放狀態與統計 =====
+# 心跳只更新記憶體中的統計並放入緩衝區，由背景執行緒批次附加到事件日誌，
+# 日誌過大時再壓縮成快照，因此不會觸發 data.json 重寫。
+
+playback_lock = threading.Lock()
+playback_stats = {}
+playback_buffer = []
+playback_state = {'loaded': False, 'last_flush': time.time(), 'flusher': None}
+
+def parse_playback_number(value, minimum=0.0, maximum=None):
+    """將事件中的數值轉成有限浮點數，無法解析或非有限值時丟出 ValueError"""
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"非有限數值: {value!r}")
+    number = max(number, minimum)
+    return number if maximum is None else min(number, maximum)
+
+def normalize_playback_event(event):
+    """驗證並整理播放事件欄位，任何欄位不合法時丟出 ValueError"""
+    if not isinstance(event, dict) or not isinstance(event.get('path'), str) or not event['path']:
+        raise ValueError("事件缺少 path")
+    normalized = {'path': event['path'], 'type': event.get('type')}
+    if event.get('watched') is not None:
+        normalized['watched'] = parse_playback_number(event['watched'], maximum=PLAYBACK_MAX_WATCHED)
+    for key in ('position', 'speed', 'duration'):
+        if event.get(key) is not None:
+            normalized[key] = parse_playback_number(event[key])
+    if isinstance(event.get('ts'), str):
+        normalized['ts'] = event['ts']  # 只來自伺服器寫入的日誌
+    return normalized
+
+def apply_playback_event(event):
+    """將已整理過的播放事件套用到記憶體統計（需持有 playback_lock）"""
+    path = event['path']
+    stats = playback_stats.setdefault(path, {
+        'play_count': 0,
+        'watch_time': 0.0,
+        'position': 0.0,
+        'speed': 1.0,
+        'duration': 0.0,
+        'last_played': None
+    })
+    if event.get('type') == 'start':
+        stats['play_count'] += 1
+    stats['watch_time'] += event.get('watched', 0.0)
+    for key in ('position', 'speed', 'duration'):
+        if key in event:
+            stats[key] = event[key]
+    stats['last_played'] = event.get('ts') or stats['last_played']
+
+def load_playback_stats():
+    """載入快照並重播快照之後的事件日誌（需持有 playback_lock）"""
+    if playback_state['loaded']:
+        return
+    offset = 0
+    if os.path.exists(PLAYBACK_STATS_FILE):
+        try:
+            with open(PLAYBACK_STATS_FILE, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            playback_stats.update(snapshot.get('videos', {}))
+            offset = snapshot.get('log_offset', 0)
+        except Exception as e:
+            print(f"讀取播放統計快照失敗: {e}")
+    if os.path.exists(PLAYBACK_EVENTS_FILE):
+        # 日誌比快照記錄的位置還短，代表壓縮時已截斷日誌
+        if os.path.getsize(PLAYBACK_EVENTS_FILE) < offset:
+            offset = 0
+        with open(PLAYBACK_EVENTS_FILE, 'r', encoding='utf-8') as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    apply_playback_event(normalize_playback_event(json.loads(line)))
+                except (TypeError, ValueError):
+                    continue  # 忽略寫到一半或不合法的行
+    playback_state['loaded'] = True
+
+def write_playback_snapshot(log_offset):
+    """以原子替換方式寫入播放統計快照（需持有 playback_lock）"""
+    tmp_path = PLAYBACK_STATS_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'log_offset': log_offset, 'videos': playback_stats}, f, ensure_ascii=False)
+    os.replace(tmp_path, PLAYBACK_STATS_FILE)
+
+def flush_playback_events():
+    """將緩衝中的事件批次附加到日誌，必要時壓縮"""
+    with playback_lock:
+        playback_state['last_flush'] = time.time()
+        if not playback_buffer:
+            return
+        events = playback_buffer[:]
+        del playback_buffer[:]
+        with open(PLAYBACK_EVENTS_FILE, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in events))
+        log_size = os.path.getsize(PLAYBACK_EVENTS_FILE)
+        if log_size >= PLAYBACK_COMPACT_BYTES:
+            # 先寫入涵蓋整份日誌的快照，再截斷日誌
+            write_playback_snapshot(log_size)
+            open(PLAYBACK_EVENTS_FILE, 'w').close()
+            write_playback_snapshot(0)
+
+def playback_flush_loop():
+    while True:
+        time.sleep(PLAYBACK_FLUSH_INTERVAL)
+        try:
+            flush_playback_events()
+        except Exception as e:
+            print(f"寫入播放事件失敗: {e}")
+
+def ensure_playback_flusher():
+    """啟動背景批次寫入執行緒（需持有 playback_lock）"""
+    if playback_state['flusher'] is None:
+        thread = threading.Thread(target=playback_flush_loop, daemon=True)
+        thread.start()
+        playback_state['flusher'] = thread
+
+def get_playback_snapshot():
+    """取得目前所有影片的播放統計副本"""
+    with playback_lock:
+        load_playback_stats()
+        return {path: dict(stats) for path, stats in playback_stats.items()}
+
+atexit.register(flush_playback_events)
+
 @app.route('/api/videos', methods=['GET'])
 def get_videos():
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        videos = json.load(f)
+    catalog = get_catalog()
+    tags = request.args.getlist('tag')
+    search = request.args.get('search')
+    sort_key = request.args.get('sort')
+    reverse = request.args.get('order', 'desc') != 'asc'
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', type=int)
+
+    indices = catalog.query(tags, search, sort_key if sort_key in CATALOG_SORT_KEYS else None, reverse)
+
+    # 指定播放統計排序或 with_stats 時才附加統計欄位
+    stats = None
+    if sort_key in PLAYBACK_SORT_KEYS or request.args.get('with_stats'):
+        stats = get_playback_snapshot()
+        if sort_key in PLAYBACK_SORT_KEYS:
+            # last_played 為字串、從未播放時為 None，以 (是否有值, 值) 排序避免型別混用
+            empty = '' if sort_key == 'last_played' else 0
+            def playback_sort_key(i):
+                value = stats.get(catalog.path(i), {}).get(sort_key)
+                return (value is not None, value if value is not None else empty)
+            indices.sort(key=playback_sort_key, reverse=reverse)
+
+    # 有篩選、排序或分頁時，附上原始索引供編輯、刪除等 API 使用
+    with_index = bool(tags or search or sort_key or request.args.get('offset') or limit)
+    if limit is not None:
+        indices = indices[offset:offset + limit]
+    elif offset:
+        indices = indices[offset:]
+
+    videos = []
+    for i in indices:
+        video = catalog.materialize(i)
+        if with_index:
+            video['index'] = i
+        if stats is not None:
+            video_stats = stats.get(video['path'], {})
+            video['play_count'] = video_stats.get('play_count', 0)
+            video['watch_time'] = round(video_stats.get('watch_time', 0.0), 1)
+            video['last_played'] = video_stats.get('last_played')
+        videos.append(video)
     return jsonify(videos)
 
 @app.route('/api/tags', methods=['GET'])
 def get_all_tags():
     """獲取所有已存在的標籤，用於自動完成"""
     try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            videos = json.load(f)
-        
         all_tags = set()
-        for video in videos:
-            if 'tag' in video and isinstance(video['tag'], list):
-                all_tags.update(video['tag'])
+        for tags in get_catalog().tags:
+            all_tags.update(tags)
         
         # 按字母順序排序
         sorted_tags = sorted(list(all_tags))
@@ -327,14 +2007,10 @@ def get_all_tags():
 def get_tag_stats():
     """獲取標籤統計信息"""
     try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            videos = json.load(f)
-        
         tag_counts = {}
-        for video in videos:
-            if 'tag' in video and isinstance(video['tag'], list):
-                for tag in video['tag']:
-                    tag_counts[tag] = tag_counts.get(tag, 0) + 1
+        for tags in get_catalog().tags:
+            for tag in tags:
+                tag_counts[tag] = tag_counts.get(tag, 0) + 1
         
         # 按使用頻率排序
         sorted_tags = sorted(tag_counts.items(), key=lambda x: x[1], reverse=True)
@@ -345,28 +2021,27 @@ def get_tag_stats():
 @app.route('/api/videos/<int:index>', methods=['PUT'])
 def update_video(index):
     try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            videos = json.load(f)
-        
-        if index >= len(videos):
-            return jsonify({"error": "影片索引不存在"}), 404
+        with data_file_lock:
+            videos = load_videos()
             
-        data = request.json
-        for key in ['filename', 'tag', 'description']:
-            if key == 'tag':
-                if isinstance(data[key], str):
-                    # 處理逗號分隔的字符串
-                    videos[index][key] = [tag.strip() for tag in data[key].split(',') if tag.strip()]
-                elif isinstance(data[key], list):
-                    # 處理陣列，移除空白和重複
-                    videos[index][key] = list(set([str(tag).strip() for tag in data[key] if str(tag).strip()]))
+            if index >= len(videos):
+                return jsonify({"error": "影片索引不存在"}), 404
+                
+            data = request.json
+            for key in ['filename', 'tag', 'description']:
+                if key == 'tag':
+                    if isinstance(data[key], str):
+                        # 處理逗號分隔的字符串
+                        videos[index][key] = [tag.strip() for tag in data[key].split(',') if tag.strip()]
+                    elif isinstance(data[key], list):
+                        # 處理陣列，移除空白和重複
+                        videos[index][key] = list(set([str(tag).strip() for tag in data[key] if str(tag).strip()]))
+                    else:
+                        videos[index][key] = []
                 else:
-                    videos[index][key] = []
-            else:
-                videos[index][key] = data[key]
-        
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(videos, f, indent=4, ensure_ascii=False)
+                    videos[index][key] = data[key]
+            
+            save_videos(videos)
         return jsonify({"status": "success"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -377,14 +2052,14 @@ def scan_videos():
     if not scan_path or not os.path.exists(scan_path):
         return jsonify({"error": "請提供有效的資料夾路徑"}), 400
     print(scan_path)
-    # 正確做法：讀
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        videos = json.load(f)
-
-    # 移除不存在檔案
-    videos = [v for v in videos if os.path.exists(v['path'])]
+    # 健康檢查與讀取時長較慢，先不持鎖計算，最後再重新讀取 data.json 合併結果
+    videos = load_videos()
+    health = check_library_health([v['path'] for v in videos],
+                                  {v['path']: v['volume'] for v in videos if v.get('volume')})
 
+    # 轉檔後保留的原始檔已由輸出檔取代，不再加入影片庫
     existing_files = set(v['path'] for v in videos)
+    existing_files.update(v['transcoded_from'] for v in videos if v.get('transcoded_from'))
     new_files = []
 
     for root, dirs, files in os.walk(scan_path):
@@ -393,26 +2068,45 @@ def scan_videos():
                 full_path = os.path.join(root, file)
                 print(full_path)
                 if full_path not in existing_files:
-                    name, _ = os.path.splitext(file)
-                    thumb = generate_thumbnail(full_path)
-                    current_time = datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-                    videos.append({
-                        "filename": file,
-                        "tag": [],
-                        "path": full_path,
-                        "description": "",
-                        "duration": get_video_duration(full_path),
-                        "thumbnail": thumb,
-                        "size": get_readable_size(os.path.getsize(full_path)),
-                        "add_time": current_time  # 添加掃描時間  
-                    })
                     new_files.append(full_path)
 
-    # 正確做法：寫
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(videos, f, indent=4, ensure_ascii=False)
+    # 新檔案剛由 os.walk 列出，磁碟區可以即時判斷；在取得鎖之前先算好
+    new_roots = resolve_volume_roots(new_files)
 
-    return jsonify({"added": new_files, "total": len(videos)})
+    with data_file_lock:
+        videos = load_videos()
+        # 移除不存在檔案；離線磁碟區上的影片保留並標記為 offline
+        videos = [v for v in videos if v['path'] not in health['missing']]
+        for video in videos:
+            if video['path'] in health['offline']:
+                video['offline'] = True
+            elif video['path'] in existing_files:
+                video.pop('offline', None)
+                # 舊資料在檔案可存取時補記健康檢查判斷出的磁碟區
+                if not video.get('volume') and video['path'] in health['roots']:
+                    video['volume'] = health['roots'][video['path']]
+        current_paths = set(v['path'] for v in videos)
+        current_paths.update(v['transcoded_from'] for v in videos if v.get('transcoded_from'))
+        new_files = [path for path in new_files if path not in current_paths and os.path.exists(path)]
+        for full_path in new_files:
+            current_time = datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+            videos.append({
+                "filename": os.path.basename(full_path),
+                "tag": [],
+                "path": full_path,
+                "description": "",
+                "duration": "未知",  # 由背景工作補上
+                "thumbnail": get_thumbnail_path(full_path),
+                "size": get_readable_size(os.path.getsize(full_path)),
+                "add_time": current_time,  # 添加掃描時間  
+                "volume": new_roots.get(full_path)
+            })
+        save_videos(videos)
+
+    # 時長在背景依儲存裝置排程讀取（包含先前未能讀到時長的線上影片）；縮圖在第一次被請求時才生成
+    pending = request_durations([v['path'] for v in videos
+                                 if v.get('duration') == "未知" and not v.get('offline')])
+    return jsonify({"added": new_files, "total": len(videos), "durations_pending": pending})
 
 @app.route('/api/last_path', methods=['GET', 'POST'])
 def last_path():
@@ -438,10 +2132,28 @@ def stream_video():
 
 @app.route('/api/thumbnail')
 def get_thumbnail():
-    path = urllib.parse.unquote(request.args.get('path'))
-    if not path or not os.path.exists(path):
-        return send_file('static/thumbnails/default.png', mimetype='image/png')
-    return send_file(path, mimetype='image/png')
+    path = urllib.parse.unquote(request.args.get('path') or '')
+    if path and os.path.exists(path):
+        return send_file(path, mimetype='image/png')
+
+    # 縮圖不存在：找出對應影片並排入延遲生成
+    # 只替影片庫中的影片生成縮圖，避免對任意檔案執行 ffmpeg 並寫入縮圖
+    video_path = urllib.parse.unquote(request.args.get('video') or '')
+    if video_path not in get_catalog().path_index:
+        video_path = find_video_for_thumbnail(path) if path else None
+    if video_path:
+        thumbnail_path = get_thumbnail_path(video_path)
+        if os.path.exists(thumbnail_path):
+            return send_file(thumbnail_path, mimetype='image/png')
+        status = request_thumbnail(video_path) if os.path.exists(video_path) else 'failed'
+    else:
+        status = 'failed'
+
+    # 預設圖不可快取，之後的請求才能拿到生成好的縮圖
+    response = send_file(DEFAULT_THUMBNAIL, mimetype='image/png', max_age=0)
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Thumbnail-Status'] = status
+    return response
 
 @app.route('/api/upload_thumbnail/<int:index>', methods=['POST'])
 def upload_thumbnail(index):
@@ -453,18 +2165,14 @@ def upload_thumbnail(index):
     if not file.filename.lower().endswith(('.jpg', '.jpeg', '.png')):
         return jsonify({'error': '僅支援 jpg/jpeg/png'}), 400
 
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        videos = json.load(f)
+    videos = load_videos()
 
     video = videos[index]
     video_path = video['path']
     directory = os.path.dirname(video_path)
     new_thumb = os.path.join(directory, os.path.splitext(os.path.basename(video_path))[0] + '.jpg')
     file.save(new_thumb)
-    video['thumbnail'] = new_thumb
-
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(videos, f, indent=4, ensure_ascii=False)
+    update_video_entry(video_path, thumbnail=new_thumb)
 
     return jsonify({'status': '縮圖已更新'})
 
@@ -562,15 +2270,9 @@ def generate_thumbnails_for_video(index):
         generating_videos.discard(video_key)
         print(f"影片 {index} 縮圖生成完成，移除生成標記，當前生成隊列: {generating_videos}")
         
-        # 更新影片資料
-        video['multi_thumbnails'] = thumbnails
-        
-        # 獲取並更新影片資訊
+        # 獲取影片資訊，連同縮圖更新到影片資料
         video_info = get_video_info(video_path)
-        video.update(video_info)
-        
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(videos, f, indent=4, ensure_ascii=False)
+        update_video_entry(video_path, multi_thumbnails=thumbnails, **video_info)
         
         return jsonify({
             'status': 'success',
@@ -665,11 +2367,11 @@ def get_video_subtitles(index):
             if validate_subtitle_content(subtitle['path']):
                 valid_subtitles.append(subtitle)
         
-        # 更新影片資料中的字幕資訊
-        video['subtitles'] = valid_subtitles
+        # 內嵌字幕在第一次被請求時才擷取，不需驗證
+        valid_subtitles.extend(find_embedded_subtitles(video_path))
         
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(videos, f, indent=4, ensure_ascii=False)
+        # 更新影片資料中的字幕資訊
+        update_video_entry(video_path, subtitles=valid_subtitles)
         
         return jsonify(valid_subtitles)
     
@@ -680,8 +2382,16 @@ def get_video_subtitles(index):
 def serve_subtitle():
     """提供字幕檔案服務"""
     subtitle_path = urllib.parse.unquote(request.args.get('path'))
+    if subtitle_path in embedded_subtitle_sources and not os.path.exists(subtitle_path):
+        # 內嵌字幕：一次擷取該影片所有文字字幕軌
+        try:
+            extract_embedded_subtitles(embedded_subtitle_sources[subtitle_path])
+        except (OSError, ValueError) as e:
+            print(f"擷取內嵌字幕失敗 {subtitle_path}: {e}")
     if not subtitle_path or not os.path.exists(subtitle_path):
         return "Subtitle not found", 404
+    if subtitle_path in embedded_subtitle_sources:
+        subtitle_path = os.path.abspath(subtitle_path)
     
     # 根據字幕格式設定MIME類型
     if subtitle_path.endswith('.vtt'):
@@ -736,12 +2446,9 @@ def upload_subtitle(index):
             os.remove(subtitle_path)  # 刪除無效檔案
             return jsonify({'error': '字幕檔案格式無效'}), 400
         
-        # 重新掃描字幕檔案
-        subtitle_files = find_subtitle_files(video_path)
-        video['subtitles'] = subtitle_files
-        
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(videos, f, indent=4, ensure_ascii=False)
+        # 重新掃描字幕檔案（保留內嵌字幕）
+        subtitle_files = find_subtitle_files(video_path) + find_embedded_subtitles(video_path)
+        update_video_entry(video_path, subtitles=subtitle_files)
         
         return jsonify({
             'status': '字幕上傳成功',
@@ -774,11 +2481,8 @@ def delete_subtitle(index):
         # 更新影片資料
         video = videos[index]
         video_path = video['path']
-        subtitle_files = find_subtitle_files(video_path)
-        video['subtitles'] = subtitle_files
-        
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(videos, f, indent=4, ensure_ascii=False)
+        subtitle_files = find_subtitle_files(video_path) + find_embedded_subtitles(video_path)
+        update_video_entry(video_path, subtitles=subtitle_files)
         
         return jsonify({
             'status': '字幕刪除成功',
@@ -863,20 +2567,281 @@ def vtt_to_srt(vtt_content):
     
     return '\n'.join(srt_lines)
 
+@app.route('/api/playback/events', methods=['POST'])
+def post_playback_events():
+    """接收播放器批次送出的心跳事件"""
+    # sendBeacon 會以 text/plain 送出，因此強制解析 JSON
+    data = request.get_json(force=True, silent=True) or {}
+    events = data.get('events', [])
+    if not isinstance(events, list):
+        return jsonify({'error': 'events 必須為陣列'}), 400
+
+    accepted = 0
+    with playback_lock:
+        load_playback_stats()
+        ensure_playback_flusher()
+        for event in events:
+            # 先驗證所有欄位再更新統計，避免被拒絕的事件仍留下部分變更
+            try:
+                event = normalize_playback_event(event)
+            except (TypeError, ValueError):
+                continue
+            # 時間一律由伺服器決定，用戶端的值不可信（會影響 last_played 排序）
+            event['ts'] = datetime.datetime.now().strftime(ADD_TIME_FORMAT)
+            apply_playback_event(event)
+            playback_buffer.append(event)
+            accepted += 1
+        should_flush = (len(playback_buffer) >= PLAYBACK_FLUSH_SIZE or
+                        time.time() - playback_state['last_flush'] >= PLAYBACK_FLUSH_INTERVAL)
+
+    if should_flush:
+        flush_playback_events()
+    return jsonify({'accepted': accepted})
+
+@app.route('/api/playback', methods=['GET'])
+def get_playback_state():
+    """獲取單一影片的播放位置、速度與統計"""
+    path = urllib.parse.unquote(request.args.get('path', ''))
+    stats = get_playback_snapshot().get(path)
+    if stats is None:
+        return jsonify({'play_count': 0, 'watch_time': 0, 'position': 0,
+                        'speed': 1, 'duration': 0, 'last_played': None})
+    return jsonify(stats)
+
+@app.route('/api/playback/stats', methods=['GET'])
+def get_playback_stats():
+    """獲取所有影片的播放統計與總計"""
+    stats = get_playback_snapshot()
+    return jsonify({
+        'videos': stats,
+        'total_play_count': sum(v['play_count'] for v in stats.values()),
+        'total_watch_time': round(sum(v['watch_time'] for v in stats.values()), 1)
+    })
+
+@app.route('/api/keyframes/nearest')
+def get_nearest_keyframe():
+    """查詢最接近指定時間點的關鍵影格"""
+    path = urllib.parse.unquote(request.args.get('path', ''))
+    timestamp = request.args.get('t', type=float)
+    if not path or not os.path.exists(path):
+        return jsonify({'error': '影片檔案不存在'}), 404
+    if timestamp is None:
+        return jsonify({'error': '請提供時間點 t'}), 400
+
+    keyframe = find_nearest_keyframe(path, timestamp)
+    if keyframe is None:
+        return jsonify({'error': '無法建立關鍵影格索引'}), 500
+    return jsonify(keyframe)
+
+@app.route('/api/preview_frame')
+def get_preview_frame():
+    """回傳最接近指定時間點的關鍵影格畫面（JPEG），供播放器預覽使用"""
+    path = urllib.parse.unquote(request.args.get('path', ''))
+    timestamp = request.args.get('t', type=float)
+    width = request.args.get('width', 320, type=int)
+    if not path or not os.path.exists(path):
+        return "File not found", 404
+    if timestamp is None:
+        return "Missing timestamp", 400
+
+    seek_args, _ = get_seek_args(path, timestamp, snap=True)
+    command = [
+        'ffmpeg', '-v', 'error',
+        *seek_args,
+        '-i', path,
+        '-frames:v', '1',
+        '-vf', f'scale={width}:-2',
+        '-f', 'image2pipe', '-vcodec', 'mjpeg',
+        'pipe:1'
+    ]
+    result = run_media_command(path, command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode != 0 or not result.stdout:
+        return "Preview failed", 500
+    return Response(result.stdout, mimetype='image/jpeg')
+
+@app.route('/api/thumbnails/sprite', methods=['POST'])
+def create_thumbnail_sprite():
+    """依影片索引清單或分頁游標建立縮圖拼貼圖，回傳拼貼圖網址與位置表"""
+    if Image is None:
+        return jsonify({'error': '伺服器未安裝 Pillow，無法產生縮圖拼貼'}), 501
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    try:
+        width = int(data.get('width', 320))
+        height = int(data.get('height', 180))
+        offset = int(data.get('offset', 0))
+        limit = int(data.get('limit', 100))
+    except (TypeError, ValueError):
+        return jsonify({'error': '尺寸與分頁參數必須為整數'}), 400
+    if not (16 <= width <= 640 and 16 <= height <= 640):
+        return jsonify({'error': '縮圖尺寸無效'}), 400
+    if offset < 0 or limit <= 0:
+        return jsonify({'error': '分頁參數無效'}), 400
+
+    catalog = get_catalog()
+    if 'ids' in data:
+        if not isinstance(data['ids'], list):
+            return jsonify({'error': 'ids 必須為陣列'}), 400
+        indices = [i for i in data['ids'] if isinstance(i, int) and 0 <= i < len(catalog)]
+    else:
+        # 分頁游標：與 /api/videos 相同的篩選與排序參數
+        sort_key = data.get('sort')
+        indices = catalog.query(data.get('tags'), data.get('search'),
+                                sort_key if sort_key in CATALOG_SORT_KEYS else None,
+                                data.get('order', 'desc') != 'asc')
+        indices = indices[offset:offset + limit]
+    if not indices:
+        return jsonify({'error': '沒有可拼貼的影片'}), 400
+    if len(indices) > SPRITE_MAX_TILES:
+        return jsonify({'error': f'一次最多 {SPRITE_MAX_TILES} 張縮圖'}), 400
+
+    members = []
+    for i in indices:
+        thumb_dir_id = catalog.thumb_dir_ids[i]
+        thumb_path = catalog.dirs.join(thumb_dir_id, catalog.thumb_names[i]) if thumb_dir_id >= 0 else ''
+        members.append((i, catalog.path(i), thumb_path))
+
+    layout = build_thumbnail_sprite(members, width, height)
+    layout['sprite'] = f"/api/thumbnails/sprite/{layout['key']}.jpg"
+    return jsonify(layout)
+
+@app.route('/api/thumbnails/sprite/<key>.jpg')
+def get_thumbnail_sprite(key):
+    """提供已建立的縮圖拼貼圖，內容由鍵值決定因此可長期快取"""
+    if not all(c in '0123456789abcdef' for c in key):
+        return "Sprite not found", 404
+    sprite_path = os.path.join(SPRITE_CACHE_DIR, key + '.jpg')
+    if not os.path.exists(sprite_path):
+        return "Sprite not found", 404
+    return send_file(os.path.abspath(sprite_path), mimetype='image/jpeg', max_age=365 * 24 * 3600)
+
+@app.route('/api/health/library', methods=['GET'])
+def get_library_health():
+    """影片庫健康摘要：各磁碟區是否在線、影片數與遺失數（不會修改資料）"""
+    now = time.time()
+    if (health_cache['summary'] is None or request.args.get('refresh') or
+            now - health_cache['checked_at'] > HEALTH_CACHE_SECONDS):
+        catalog = get_catalog()
+        recorded = {catalog.path(i): catalog.extras[i]['volume'] for i in range(len(catalog))
+                    if catalog.extras[i] and catalog.extras[i].get('volume')}
+        health = check_library_health([catalog.path(i) for i in range(len(catalog))], recorded)
+        health_cache['summary'] = {
+            'volumes': list(health['volumes'].values()),
+            'total': len(catalog),
+            'offline': len(health['offline']),
+            'missing': len(health['missing']),
+            'missing_paths': sorted(health['missing']),
+            'elapsed': health['elapsed'],
+            'checked_at': datetime.datetime.fromtimestamp(now).strftime(ADD_TIME_FORMAT)
+        }
+        health_cache['checked_at'] = now
+    return jsonify(health_cache['summary'])
+
+@app.route('/api/videos/<int:index>/tracks', methods=['GET'])
+def get_video_tracks(index):
+    """列出影片內嵌的音軌與字幕軌"""
+    try:
+        catalog = get_catalog()
+        if index >= len(catalog):
+            return jsonify({"error": "影片索引不存在"}), 404
+        video_path = catalog.path(index)
+        if not os.path.exists(video_path):
+            return jsonify({"error": "影片檔案不存在"}), 404
+        return jsonify(probe_media_streams(video_path))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/transcode/jobs', methods=['GET', 'POST'])
+def transcode_jobs_route():
+    """建立批次轉檔工作，或列出所有工作"""
+    with transcode_lock:
+        load_transcode_state()
+        if request.method == 'GET':
+            return jsonify([summarize_transcode_job(job) for job in transcode_jobs.values()])
+
+    data = request.get_json() or {}
+    preset = data.get('preset', 'h264')
+    if preset not in TRANSCODE_PRESETS:
+        return jsonify({'error': f'不支援的預設：{preset}'}), 400
+
+    catalog = get_catalog()
+    if 'ids' in data:
+        indices = [i for i in data['ids'] if isinstance(i, int) and 0 <= i < len(catalog)]
+    else:
+        indices = catalog.query(data.get('tags'), data.get('search'))
+    paths = [catalog.path(i) for i in indices if os.path.exists(catalog.path(i))]
+    if not paths:
+        return jsonify({'error': '沒有符合條件的影片'}), 400
+
+    job_id = uuid.uuid4().hex[:12]
+    with transcode_lock:
+        transcode_jobs[job_id] = {
+            'id': job_id,
+            'preset': preset,
+            'delete_source': bool(data.get('delete_source', False)),
+            'status': 'queued',
+            'created_at': datetime.datetime.now().strftime(ADD_TIME_FORMAT),
+            'files': {path: {'status': 'pending', 'progress': 0} for path in paths}
+        }
+        save_transcode_state()
+    start_transcode_job(job_id)
+    return jsonify({'id': job_id, 'total': len(paths)})
+
+@app.route('/api/transcode/jobs/<job_id>', methods=['GET'])
+def get_transcode_job(job_id):
+    """獲取批次轉檔進度、每個檔案的 fps 與節省空間"""
+    with transcode_lock:
+        load_transcode_state()
+        job = transcode_jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': '轉檔工作不存在'}), 404
+        return jsonify(summarize_transcode_job(job))
+
+@app.route('/api/transcode/jobs/<job_id>/resume', methods=['POST'])
+def resume_transcode_job(job_id):
+    """從檢查點恢復中斷的批次轉檔"""
+    with transcode_lock:
+        load_transcode_state()
+        job = transcode_jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': '轉檔工作不存在'}), 404
+        if job['status'] in ('queued', 'running'):
+            return jsonify({'error': '轉檔工作正在執行中'}), 409
+        job['status'] = 'queued'
+    start_transcode_job(job_id)
+    return jsonify({'status': 'resumed'})
+
+@app.route('/api/preview_clip')
+def get_preview_clip():
+    """提供滑鼠移入預覽用的短片段（支援 Range 請求）"""
+    path = urllib.parse.unquote(request.args.get('path', ''))
+    fmt = request.args.get('format', 'mp4')
+    if fmt not in PREVIEW_FORMATS:
+        return "Unsupported format", 400
+    if not path or not os.path.exists(path):
+        return "File not found", 404
+
+    clip_path = generate_preview_clip(path, fmt)
+    if not clip_path:
+        return "Preview failed", 500
+    mimetype = 'video/webm' if fmt == 'webm' else 'video/mp4'
+    return send_file(os.path.abspath(clip_path), mimetype=mimetype, conditional=True)
+
 if __name__ == '__main__':
     app.run(debug=True)
 
 @app.route('/api/videos/<int:index>', methods=['DELETE'])
 def delete_video(index):
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        videos = json.load(f)
-    
-    path = videos[index]['path']
-    print(path)
-    new_videos = [v for v in videos if v['path'] != path]
-    print(new_videos)
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(new_videos, f, indent=4, ensure_ascii=False)
+    with data_file_lock:
+        videos = load_videos()
+        
+        path = videos[index]['path']
+        print(path)
+        new_videos = [v for v in videos if v['path'] != path]
+        print(new_videos)
+        save_videos(new_videos)
     return jsonify({'status': 'deleted'})
 
 @app.route('/api/videos/delete_batch', methods=['POST'])
@@ -884,22 +2849,21 @@ def delete_batch():
     data = request.get_json()
     indexes = data.get('indexes', [])
 
-    # 讀取目前影片清單
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        videos = json.load(f)
+    with data_file_lock:
+        # 讀取目前影片清單
+        videos = load_videos()
 
-    # 按 index 排除要刪掉的影片
-    new_videos = [v for i, v in enumerate(videos) if i not in indexes]
+        # 按 index 排除要刪掉的影片
+        new_videos = [v for i, v in enumerate(videos) if i not in indexes]
 
-    # 存回檔案
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(new_videos, f, indent=4, ensure_ascii=False)
+        # 存回檔案
+        save_videos(new_videos)
 
     return jsonify({'status': 'deleted'})
 
 @app.route('/api/videos/reorder', methods=['POST'])
 def reorder_videos():
     videos = request.get_json()
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(videos, f, indent=4, ensure_ascii=False)
+    with data_file_lock:
+        save_videos(videos)
     return jsonify({'status': '排序已更新'})